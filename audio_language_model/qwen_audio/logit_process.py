@@ -48,14 +48,11 @@ def TopPLogitsWarper(scores, top_p):
     min_tokens_to_keep = 1
     sorted_indices_to_remove[..., -min_tokens_to_keep:] = 0
 
-    # scatter sorted tensors to original indexing
-    indices_to_remove = np.copy(sorted_indices_to_remove)
-    np.put_along_axis(
-        indices_to_remove, sorted_indices, sorted_indices_to_remove, axis=1
-    )
+    # scatter the filtered sorted logits back to original indexing, in place
+    sorted_logits[sorted_indices_to_remove] = -np.inf
+    np.put_along_axis(scores, sorted_indices, sorted_logits, axis=-1)
 
-    scores_processed = np.where(indices_to_remove, -np.inf, scores)
-    return scores_processed
+    return scores
 
 
 def logits_processor(input_ids, scores, top_p=0.5):
@@ -14,7 +14,6 @@ import ailia
 sys.path.append("../../util")
 from arg_utils import get_base_parser, update_parser  # noqa
 from model_utils import check_and_download_models, check_and_download_file  # noqa
-from math_utils import softmax
 
 from logit_process import logits_processor
 from audio_utils import process_audio
@@ -48,6 +47,11 @@ parser.add_argument(
     "--disable_ailia_tokenizer", action="store_true", help="disable ailia tokenizer."
 )
 parser.add_argument("--onnx", action="store_true", help="execute onnxruntime version.")
+parser.add_argument(
+    "--tensorrt",
+    action="store_true",
+    help="use the TensorRT execution provider (fp16, engine cache) with --onnx.",
+)
 args = update_parser(parser)
 
 
@@ -60,8 +64,19 @@ WEIGHT_ENC_PATH = "Qwen-Audio-Chat_encode.onnx"
 MODEL_PATH = "Qwen-Audio-Chat.onnx.prototxt"
 MODEL_ENC_PATH = "Qwen-Audio-Chat_encode.onnx.prototxt"
 PB_PATH = "Qwen-Audio-Chat_weights.pb"
+TRT_CACHE_PATH = "trt_cache"
 
 SYSTEM_PROMPT = "You are a helpful assistant."
+MAX_LENGTH = 690
+
+NUM_LAYERS = 32
+KV_CACHE_NAMES = [
+    name
+    for i in range(NUM_LAYERS)
+    for name in ("key_cache%d" % i, "value_cache%d" % i)
+]
+KV_CACHE_OUT_NAMES = [name.replace("_cache", "_cache_out") for name in KV_CACHE_NAMES]
+EMPTY_KV_CACHE = np.zeros((1, 0, 32, 128), dtype=np.float16)
 
 
 # ======================
@@ -187,17 +202,25 @@ def decode_tokens(
     return trim_decode_tokens
 
 
+def past_length(past_key_values):
+    kv = past_key_values[0]
+    # with onnxruntime the cache is kept as OrtValue
+    shape = kv.shape if isinstance(kv, np.ndarray) else kv.shape()
+    return shape[1]
+
+
 # ======================
 # Main functions
 # ======================
 
 
 def audio_encode(models, input_audios, input_audio_lengths, audio_span_tokens):
-    real_input_audio_lens = input_audio_lengths[:, 0].tolist()
-    max_len_in_batch = max(real_input_audio_lens)
-    padding_mask = np.ones([input_audios.shape[0], max_len_in_batch], dtype=np.float16)
-    for index in range(len(input_audios)):
-        padding_mask[index, : input_audio_lengths[index][0]] = 0
+    real_input_audio_lens = input_audio_lengths[:, :1]
+    max_len_in_batch = int(real_input_audio_lens.max())
+    # 1 for the padded frames beyond each audio length
+    padding_mask = (np.arange(max_len_in_batch) >= real_input_audio_lens).astype(
+        np.float16
+    )
 
     # feedforward
     net = models["enc"]
@@ -215,15 +238,21 @@ def audio_encode(models, input_audios, input_audio_lengths, audio_span_tokens):
         )
     x = output[0]
 
-    bos = np.load(os.path.join(os.path.dirname(__file__), "bos.npy"))
-    eos = np.load(os.path.join(os.path.dirname(__file__), "eos.npy"))
+    bos = models["bos"].astype(x.dtype, copy=False)
+    eos = models["eos"].astype(x.dtype, copy=False)
 
+    # bos + audio + eos of each audio, written into one buffer
+    out = np.empty(
+        (len(audio_span_tokens), max(audio_span_tokens), x.shape[-1]), dtype=x.dtype
+    )
     output_audios = []
     for i in range(len(audio_span_tokens)):
         audio_span = audio_span_tokens[i]
-        audio = x[i][: audio_span - 2]
-        audio = np.concatenate([bos, audio, eos])
-        assert len(audio) == audio_span
+        assert audio_span - 2 <= x.shape[1]
+        audio = out[i, :audio_span]
+        audio[0] = bos[0]
+        audio[1:-1] = x[i, : audio_span - 2]
+        audio[-1] = eos[0]
         output_audios.append(audio)
 
     return output_audios
@@ -237,10 +266,8 @@ def forward(
     past_key_values: List[np.ndarray],
     blob_copy: bool,
 ):
-    audios = audio_info["input_audios"]
     audio_span_tokens = audio_info["audio_span_tokens"]
-    input_audio_lengths = audio_info["input_audio_lengths"]
-    if 0 < past_key_values[0].shape[1]:
+    if 0 < past_length(past_key_values):
         audios = (
             np.ones(
                 (len(audio_span_tokens), input_ids.shape[1], 4096), dtype=np.float16
@@ -249,12 +276,15 @@ def forward(
         )
     else:
         audio_start_id = 155163
-        bos_pos = np.where(input_ids == audio_start_id)
-        eos_pos = np.where(input_ids == audio_start_id + 1)
+        # audio bos/eos markers in one scan, then split by the marker id
+        batch_idx, pos = np.nonzero(
+            (input_ids == audio_start_id) | (input_ids == audio_start_id + 1)
+        )
+        is_bos = input_ids[batch_idx, pos] == audio_start_id
 
-        audio_pos = np.stack((bos_pos[0], bos_pos[1], eos_pos[1]), axis=1)
+        audio_pos = np.stack((batch_idx[is_bos], pos[is_bos], pos[~is_bos]), axis=1)
 
-        audios = audio_encode(models, audios, input_audio_lengths, audio_span_tokens)
+        audios = audio_info["audio_embeds"]
         lst = []
         for idx, (i, a, b) in enumerate(audio_pos):
             lst.append(
@@ -282,124 +312,51 @@ def forward(
             )
             logits, new_past_key_values = output[0], output[1:]
         else:
-            NUM_KV = 32
-            key_shapes = [
-                net.get_blob_shape(
-                    net.find_blob_index_by_name("key_cache_out" + str(i))
-                )
-                for i in range(NUM_KV)
+            # blob indices are looked up once in main()
+            blob_idx = models["blob_idx"]
+            kv_shapes = [
+                net.get_blob_shape(blob_idx[name]) for name in KV_CACHE_OUT_NAMES
             ]
-            value_shapes = [
-                net.get_blob_shape(
-                    net.find_blob_index_by_name("value_cache_out" + str(i))
-                )
-                for i in range(NUM_KV)
-            ]
-            net.set_input_blob_data(input_ids, net.find_blob_index_by_name("input_ids"))
-            net.set_input_blob_data(
-                attention_mask, net.find_blob_index_by_name("attention_mask")
-            )
-            net.set_input_blob_data(audios, net.find_blob_index_by_name("audios"))
-            for i in range(NUM_KV):
-                net.set_input_blob_shape(
-                    key_shapes[i], net.find_blob_index_by_name("key_cache" + str(i))
-                )
-                net.set_input_blob_shape(
-                    value_shapes[i], net.find_blob_index_by_name("value_cache" + str(i))
-                )
-                net.copy_blob_data("key_cache" + str(i), "key_cache_out" + str(i))
-                net.copy_blob_data("value_cache" + str(i), "value_cache_out" + str(i))
+            net.set_input_blob_data(input_ids, blob_idx["input_ids"])
+            net.set_input_blob_data(attention_mask, blob_idx["attention_mask"])
+            net.set_input_blob_data(audios, blob_idx["audios"])
+            for name, out_name, shape in zip(
+                KV_CACHE_NAMES, KV_CACHE_OUT_NAMES, kv_shapes
+            ):
+                net.set_input_blob_shape(shape, blob_idx[name])
+                net.copy_blob_data(name, out_name)
             net.update()
-            logits = net.get_blob_data(net.find_blob_index_by_name("logits"))
-            new_past_key_values = [
-                net.get_blob_data(net.find_blob_index_by_name("key_cache_out0"))
-            ]
+            logits = net.get_blob_data(blob_idx["logits"])
+            new_past_key_values = [net.get_blob_data(blob_idx["key_cache_out0"])]
     else:
-        output = net.run(
-            None,
-            {
-                "input_ids": input_ids,
-                "attention_mask": attention_mask,
-                "audios": audios,
-                "key_cache0": past_key_values[0],
-                "value_cache0": past_key_values[1],
-                "key_cache1": past_key_values[2],
-                "value_cache1": past_key_values[3],
-                "key_cache2": past_key_values[4],
-                "value_cache2": past_key_values[5],
-                "key_cache3": past_key_values[6],
-                "value_cache3": past_key_values[7],
-                "key_cache4": past_key_values[8],
-                "value_cache4": past_key_values[9],
-                "key_cache5": past_key_values[10],
-                "value_cache5": past_key_values[11],
-                "key_cache6": past_key_values[12],
-                "value_cache6": past_key_values[13],
-                "key_cache7": past_key_values[14],
-                "value_cache7": past_key_values[15],
-                "key_cache8": past_key_values[16],
-                "value_cache8": past_key_values[17],
-                "key_cache9": past_key_values[18],
-                "value_cache9": past_key_values[19],
-                "key_cache10": past_key_values[20],
-                "value_cache10": past_key_values[21],
-                "key_cache11": past_key_values[22],
-                "value_cache11": past_key_values[23],
-                "key_cache12": past_key_values[24],
-                "value_cache12": past_key_values[25],
-                "key_cache13": past_key_values[26],
-                "value_cache13": past_key_values[27],
-                "key_cache14": past_key_values[28],
-                "value_cache14": past_key_values[29],
-                "key_cache15": past_key_values[30],
-                "value_cache15": past_key_values[31],
-                "key_cache16": past_key_values[32],
-                "value_cache16": past_key_values[33],
-                "key_cache17": past_key_values[34],
-                "value_cache17": past_key_values[35],
-                "key_cache18": past_key_values[36],
-                "value_cache18": past_key_values[37],
-                "key_cache19": past_key_values[38],
-                "value_cache19": past_key_values[39],
-                "key_cache20": past_key_values[40],
-                "value_cache20": past_key_values[41],
-                "key_cache21": past_key_values[42],
-                "value_cache21": past_key_values[43],
-                "key_cache22": past_key_values[44],
-                "value_cache22": past_key_values[45],
-                "key_cache23": past_key_values[46],
-                "value_cache23": past_key_values[47],
-                "key_cache24": past_key_values[48],
-                "value_cache24": past_key_values[49],
-                "key_cache25": past_key_values[50],
-                "value_cache25": past_key_values[51],
-                "key_cache26": past_key_values[52],
-                "value_cache26": past_key_values[53],
-                "key_cache27": past_key_values[54],
-                "value_cache27": past_key_values[55],
-                "key_cache28": past_key_values[56],
-                "value_cache28": past_key_values[57],
-                "key_cache29": past_key_values[58],
-                "value_cache29": past_key_values[59],
-                "key_cache30": past_key_values[60],
-                "value_cache30": past_key_values[61],
-                "key_cache31": past_key_values[62],
-                "value_cache31": past_key_values[63],
-            },
-        )
-        logits, new_past_key_values = output[0], output[1:]
+        # the key/value cache stays on the device, only the logits are copied back
+        io_binding = models["io_binding"]
+        io_binding.bind_cpu_input("input_ids", input_ids)
+        io_binding.bind_cpu_input("attention_mask", attention_mask)
+        io_binding.bind_cpu_input("audios", audios)
+        for name, kv in zip(KV_CACHE_NAMES, past_key_values):
+            if isinstance(kv, np.ndarray):
+                io_binding.bind_cpu_input(name, kv)
+            else:
+                io_binding.bind_ortvalue_input(name, kv)
+        # device and output names are resolved once in main()
+        device = models["device"]
+        output_names = models["output_names"]
+        io_binding.bind_output(output_names[0], "cpu")
+        for name in output_names[1:]:
+            io_binding.bind_output(name, device)
+        net.run_with_iobinding(io_binding)
+        output = io_binding.get_outputs()
+        logits, new_past_key_values = output[0].numpy(), output[1:]
 
     return logits, new_past_key_values
 
 
 def stopping_criteria(input_ids: np.array) -> np.array:
-    max_length = 690
-    cur_len = input_ids.shape[-1]
-    is_done = cur_len >= max_length
-    is_done = np.full(input_ids.shape[0], is_done)
+    eos_token_id = 151643
 
-    eos_token_id = np.array([151643])
-    is_done = is_done | np.isin(input_ids[:, -1], eos_token_id)
+    cur_len = input_ids.shape[-1]
+    is_done = (cur_len >= MAX_LENGTH) | (input_ids[:, -1] == eos_token_id)
 
     return is_done
 
@@ -407,27 +364,34 @@ def stopping_criteria(input_ids: np.array) -> np.array:
 def sample(models, input_ids, attention_mask, audio_info):
     pad_token_id = 151643
 
-    past_key_values = [np.zeros((1, 0, 32, 128), dtype=np.float16)] * 64
+    # the empty cache is shared by all layers, it is never written in place
+    past_key_values = [EMPTY_KV_CACHE] * len(KV_CACHE_NAMES)
 
     # keep track of which sequences are already finished
     batch_size, cur_len = input_ids.shape
     this_peer_finished = False
     unfinished_sequences = np.ones(batch_size, dtype=int)
-    cache_position = (
-        np.cumsum(np.ones_like(input_ids[0, :], dtype=np.int64), axis=0) - 1
-    )
+    # position of the last token in the cache
+    cache_position = cur_len - 1
+
+    # the ids and the mask grow by one column per step,
+    # slice them from preallocated buffers
+    buf_len = max(MAX_LENGTH, cur_len) + 1
+    input_ids_buf = np.empty((batch_size, buf_len), dtype=input_ids.dtype)
+    input_ids_buf[:, :cur_len] = input_ids
+    input_ids = input_ids_buf[:, :cur_len]
+    attention_mask_buf = np.ones((batch_size, buf_len), dtype=attention_mask.dtype)
+    attention_mask_buf[:, :cur_len] = attention_mask
+    attention_mask = attention_mask_buf[:, :cur_len]
 
     blob_copy = False
     while True:
         # prepare model inputs
-        if 0 < past_key_values[0].shape[1]:
-            model_input_ids = input_ids[:, cache_position]
+        past_len = past_length(past_key_values)
+        if 0 < past_len:
+            model_input_ids = input_ids[:, cache_position : cache_position + 1]
         else:
             model_input_ids = input_ids
-        position_ids = attention_mask.astype(np.int32).cumsum(axis=-1) - 1
-        position_ids = np.where(attention_mask == 0, 1, position_ids)
-        if 0 < past_key_values[0].shape[1]:
-            position_ids = position_ids[:, -1:]
 
         if args.benchmark:
             start = int(round(time.time() * 1000))
@@ -447,20 +411,18 @@ def sample(models, input_ids, attention_mask, audio_info):
             estimation_time = end - start
             logger.info(f"\tdecode time {estimation_time} ms")
 
-        attention_mask = np.concatenate(
-            [attention_mask, np.ones((attention_mask.shape[0], 1), dtype=int)],
-            axis=-1,
-        )
-        cache_position = cache_position[-1:] + 1
+        attention_mask = attention_mask_buf[:, : attention_mask.shape[1] + 1]
+        cache_position += 1
 
-        next_token_logits = logits[:, -1, :]
+        # the processors work in place on this (contiguous) slice
+        next_token_logits = np.ascontiguousarray(logits[:, -1, :])
 
         # pre-process distribution
         next_token_scores = logits_processor(input_ids, next_token_logits)
 
-        # token selection
-        probs = softmax(next_token_scores, axis=-1)
-        next_tokens = np.random.choice(len(probs[0]), size=1, p=probs[0])
+        # token selection, sampling from softmax(scores) by the gumbel-max trick
+        gumbel = np.random.gumbel(size=next_token_scores.shape)
+        next_tokens = np.argmax(next_token_scores + gumbel, axis=-1)
 
         # finished sentences should have their next token be a padding token
         next_tokens = next_tokens * unfinished_sequences + pad_token_id * (
@@ -468,7 +430,8 @@ def sample(models, input_ids, attention_mask, audio_info):
         )
 
         # update generated ids, model inputs, and length for next step
-        input_ids = np.concatenate([input_ids, next_tokens[:, None]], axis=-1)
+        input_ids_buf[:, cur_len] = next_tokens
+        input_ids = input_ids_buf[:, : cur_len + 1]
 
         unfinished_sequences = unfinished_sequences & ~stopping_criteria(input_ids)
         this_peer_finished = np.max(unfinished_sequences) == 0
@@ -496,6 +459,19 @@ def predict(models, query, history: Optional[List[Tuple[str, str]]] = None):
     )
     audio_info = process_audio(raw_text)
 
+    # run the audio encoder once for the same audios
+    key = tuple(audio_info["audio_urls"])
+    cache = getattr(audio_encode, "cache", {})
+    if key not in cache:
+        cache[key] = audio_encode(
+            models,
+            audio_info["input_audios"],
+            audio_info["input_audio_lengths"],
+            audio_info["audio_span_tokens"],
+        )
+        audio_encode.cache = cache
+    audio_info["audio_embeds"] = cache[key]
+
     input_ids = np.array([context_tokens])
     attention_mask = np.ones(input_ids.shape[:2], dtype=np.int64)
     outputs = sample(models, input_ids, attention_mask, audio_info)
@@ -563,6 +539,9 @@ def main():
 
     env_id = args.env_id
 
+    if args.tensorrt and not args.onnx:
+        logger.warning("--tensorrt is only used with --onnx.")
+
     # initialize
     if not args.onnx:
         memory_mode = ailia.get_memory_mode(
@@ -571,17 +550,55 @@ def main():
             reduce_interstage=False,
             reuse_interstage=True,
         )
+        # the decoder also releases the intermediate blobs once consumed,
+        # a smaller working set for a little more allocation per step
+        dec_memory_mode = ailia.get_memory_mode(
+            reduce_constant=True,
+            ignore_input_with_initializer=True,
+            reduce_interstage=True,
+            reuse_interstage=True,
+        )
         enc = ailia.Net(
             MODEL_ENC_PATH, WEIGHT_ENC_PATH, env_id=env_id, memory_mode=memory_mode
         )
-        net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=env_id, memory_mode=memory_mode)
+        net = ailia.Net(
+            MODEL_PATH, WEIGHT_PATH, env_id=env_id, memory_mode=dec_memory_mode
+        )
     else:
         import onnxruntime
 
+        # decoding runs many small kernels, use the physical cores without spin-waiting
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = max(1, (os.cpu_count() or 1) // 2)
+        options.inter_op_num_threads = 1
+        options.add_session_config_entry("session.intra_op.allow_spinning", "0")
         providers = ["CUDAExecutionProvider", "CPUExecutionProvider"]
+        if args.tensorrt:
+            # the engine is built on the first run and loaded from the cache after that
+            providers.insert(
+                0,
+                (
+                    "TensorrtExecutionProvider",
+                    {
+                        "trt_fp16_enable": True,
+                        "trt_engine_cache_enable": True,
+                        "trt_engine_cache_path": TRT_CACHE_PATH,
+                        "trt_max_workspace_size": 2 << 30,
+                        "trt_builder_optimization_level": 5,
+                    },
+                ),
+            )
 
-        enc = onnxruntime.InferenceSession(WEIGHT_ENC_PATH, providers=providers)
-        net = onnxruntime.InferenceSession(WEIGHT_PATH, providers=providers)
+        enc = onnxruntime.InferenceSession(
+            WEIGHT_ENC_PATH, sess_options=options, providers=providers
+        )
+        net = onnxruntime.InferenceSession(
+            WEIGHT_PATH, sess_options=options, providers=providers
+        )
 
     args.disable_ailia_tokenizer = True
     if args.disable_ailia_tokenizer:
@@ -593,11 +610,29 @@ def main():
     else:
         raise NotImplementedError
 
+    # audio bos/eos embeddings, constant across calls
+    bos = np.load(os.path.join(os.path.dirname(__file__), "bos.npy"))
+    eos = np.load(os.path.join(os.path.dirname(__file__), "eos.npy"))
+
     models = {
         "tokenizer": tokenizer,
         "enc": enc,
         "net": net,
+        "bos": bos,
+        "eos": eos,
     }
+    if args.onnx:
+        models["io_binding"] = net.io_binding()
+        models["device"] = (
+            "cuda" if "CUDAExecutionProvider" in net.get_providers() else "cpu"
+        )
+        models["output_names"] = [output.name for output in net.get_outputs()]
+    else:
+        names = ["input_ids", "attention_mask", "audios", "logits"]
+        models["blob_idx"] = {
+            name: net.find_blob_index_by_name(name)
+            for name in names + KV_CACHE_NAMES + KV_CACHE_OUT_NAMES
+        }
 
     # generate
     recognize(models)
@@ -80,6 +80,11 @@ parser.add_argument("--temperature", type=float, default=1.0, help="temperature"
 parser.add_argument("--speed", type=float, default=1.0, help="Speech rate")
 parser.add_argument("--onnx", action="store_true", help="use onnx runtime")
 parser.add_argument("--profile", action="store_true", help="use profile model")
+parser.add_argument(
+    "--argmax_eos",
+    action="store_true",
+    help="also stop decoding when the greedy token is EOS",
+)
 args = update_parser(parser, check_input_type=False)
 
 
@@ -225,6 +230,10 @@ class T2SModel:
             logger.info("\tsencoder processing time {} ms".format(end - start))
 
         prefix_len = prompts.shape[1]
+        if early_stop_num != -1:
+            max_len = prefix_len + int(early_stop_num[0])
+        else:
+            max_len = 10**9
 
         if args.benchmark:
             start = int(round(time.time() * 1000))
@@ -255,13 +264,19 @@ class T2SModel:
             end = int(round(time.time() * 1000))
             logger.info("\tfsdec processing time {} ms".format(end - start))
 
+        if args.onnx:
+            # logits are only fetched for the greedy EOS check
+            output_names = [output.name for output in self.sess_sdec.get_outputs()]
+            if not args.argmax_eos:
+                output_names = [n for n in output_names if n != "logits"]
+
         stop = False
         for idx in tqdm(range(1, 1500)):
             if args.benchmark:
                 start = int(round(time.time() * 1000))
             if args.onnx:
-                y, k, v, y_emb, logits, samples = self.sess_sdec.run(
-                    None,
+                outputs = dict(zip(output_names, self.sess_sdec.run(
+                    output_names,
                     {
                         "iy": y,
                         "ik": k,
@@ -273,7 +288,11 @@ class T2SModel:
                         "temperature": temperature,
                         "repetition_penalty": repetition_penalty,
                     },
-                )
+                )))
+                y, k, v, y_emb = outputs["y"], outputs["k"], outputs["v"], outputs["y_emb"]
+                samples = outputs["samples"]
+                if args.argmax_eos:
+                    logits = outputs["logits"]
             else:
                 COPY_INPUT_BLOB_DATA = False
                 if idx == 1:
@@ -325,21 +344,24 @@ class T2SModel:
                         k = self.sess_sdec.get_blob_data(output_blob_idx[1])
                         v = self.sess_sdec.get_blob_data(output_blob_idx[2])
                     y_emb = self.sess_sdec.get_blob_data(output_blob_idx[3])
-                    logits = self.sess_sdec.get_blob_data(output_blob_idx[4])
+                    if args.argmax_eos:
+                        logits = self.sess_sdec.get_blob_data(output_blob_idx[4])
                     samples = self.sess_sdec.get_blob_data(output_blob_idx[5])
 
             if args.benchmark:
                 end = int(round(time.time() * 1000))
                 logger.info("\tsdec processing time {} ms".format(end - start))
-            if early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num:
+            if y.shape[1] > max_len:
+                stop = True
+            if samples[0, 0] == EOS:
                 stop = True
-            if np.argmax(logits, axis=-1)[0] == EOS or samples[0, 0] == EOS:
+            elif args.argmax_eos and np.argmax(logits, axis=-1)[0] == EOS:
                 stop = True
             if stop:
                 break
         y[0, -1] = 0
 
-        return y[np.newaxis, :, -idx:-1]
+        return np.ascontiguousarray(y[:, -idx:-1])[np.newaxis, ...]
 
 
 class GptSoVits:
@@ -419,17 +441,11 @@ class SSLModel:
 
 def get_phones_and_bert(text, language, final=False):
     if language == "en":
-        try:
-            import LangSegment
-
-            LangSegment.setfilters(["en"])
-            formattext = " ".join(tmp["text"] for tmp in LangSegment.getTexts(text))
-        except ImportError:
-            formattext = text
+        formattext = " ".join(text.split())
     else:
         formattext = text
-    while "  " in formattext:
-        formattext = formattext.replace("  ", " ")
+        while "  " in formattext:
+            formattext = formattext.replace("  ", " ")
 
     phones, word2ph, norm_text = clean_text(formattext, language)
     phones = cleaned_text_to_sequence(phones)
@@ -480,8 +496,9 @@ def generate_voice(ssl, t2s_encoder, t2s_first_decoder, t2s_stage_decoder, vits)
         )
 
     # hubertの入力のみpaddingする
-    ref_audio_16k = np.concatenate([ref_audio_16k, zero_wav], axis=0)
-    ref_audio_16k = ref_audio_16k[np.newaxis, :]
+    wav16k = ref_audio_16k
+    ref_audio_16k = np.zeros((1, wav16k.shape[0] + zero_wav.shape[0]), dtype=np.float32)
+    ref_audio_16k[0, : wav16k.shape[0]] = wav16k
     ssl_content = ssl.forward(ref_audio_16k)
 
     text = cut(text)  # Slice once every 4 sentences
@@ -0,0 +1,44 @@
+# Dynamic int8 quantization of the GPT-SoVITS onnx models.
+# Run from the gpt-sovits directory after gpt-sovits.py has downloaded the models:
+#   python3 export/quantize_gpt_sovits.py
+# gpt-sovits.py --onnx loads the *_int8.onnx files when they exist.
+
+import os
+import argparse
+
+from onnxruntime.quantization import quantize_dynamic, QuantType
+
+# cnhubert is kept in fp32 because its features condition the whole synthesis
+TARGETS = [
+    't2s_encoder.onnx',
+    't2s_fsdec.onnx',
+    't2s_sdec.onnx',
+    't2s_sdec.opt3.onnx',
+    'vits.onnx',
+]
+
+parser = argparse.ArgumentParser(description='GPT-SoVITS int8 quantization')
+parser.add_argument(
+    '--model_dir', default='.',
+    help='directory containing the downloaded onnx models'
+)
+args = parser.parse_args()
+
+
+def main():
+    for name in TARGETS:
+        src = os.path.join(args.model_dir, name)
+        if not os.path.exists(src):
+            print('skip ' + src + ' (not found)')
+            continue
+        dst = src.replace('.onnx', '_int8.onnx')
+        quantize_dynamic(
+            src, dst,
+            weight_type=QuantType.QInt8,
+            op_types_to_quantize=['MatMul', 'Gemm'],
+        )
+        print('saved ' + dst)
+
+
+if __name__ == '__main__':
+    main()
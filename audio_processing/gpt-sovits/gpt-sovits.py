@@ -1,6 +1,8 @@
+import os
 import time
 import sys
 import platform
+import hashlib
 
 import numpy as np
 import soundfile as sf
@@ -24,6 +26,8 @@ import librosa
 
 SAVE_WAV_PATH = 'output.wav'
 REMOTE_PATH = 'https://storage.googleapis.com/ailia-models/gpt-sovits/'
+REF_CACHE_DIR = '~/.cache/gpt-sovits'
+TRT_CACHE_PATH = 'trt_cache'
 
 # ======================
 # Arguemnt Parser Config
@@ -69,6 +73,18 @@ parser.add_argument(
     '--ailia_voice', action='store_true',
     help='use ailia voice for G2P'
 )
+parser.add_argument(
+    '--ref_cache', action='store_true',
+    help='cache the reference phonemes and ssl features in ' + REF_CACHE_DIR
+)
+parser.add_argument(
+    '--argmax_eos', action='store_true',
+    help='also stop decoding when the greedy token is EOS'
+)
+parser.add_argument(
+    '--tensorrt', action='store_true',
+    help='use the TensorRT execution provider (fp16, engine cache) with --onnx'
+)
 args = update_parser(parser, check_input_type=False)
 
 WEIGHT_PATH_SSL = 'cnhubert.onnx'
@@ -110,8 +126,11 @@ class T2SModel():
     def __init__(self, sess_encoder, sess_fsdec, sess_sdec):
         self.hz = 50
         self.max_sec = 54
-        self.top_k = 5
         self.early_stop_num = np.array([self.hz * self.max_sec])
+        self.top_k = np.array([5], dtype=np.int64)
+        self.top_p = np.array([1.0], dtype=np.float32)
+        self.temperature = np.array([1.0], dtype=np.float32)
+        self.repetition_penalty = np.array([1.35], dtype=np.float32)
         self.sess_encoder = sess_encoder
         self.sess_fsdec = sess_fsdec
         self.sess_sdec = sess_sdec
@@ -119,10 +138,10 @@ class T2SModel():
     def forward(self, ref_seq, text_seq, ref_bert, text_bert, ssl_content):
         early_stop_num = self.early_stop_num
 
-        top_k = np.array([5], dtype=np.int64)
-        top_p = np.array([1.0], dtype=np.float32)
-        temperature = np.array([1.0], dtype=np.float32)
-        repetition_penalty = np.array([1.35], dtype=np.float32)
+        top_k = self.top_k
+        top_p = self.top_p
+        temperature = self.temperature
+        repetition_penalty = self.repetition_penalty
 
         EOS = 1024
 
@@ -137,6 +156,10 @@ class T2SModel():
             logger.info("\tsencoder processing time {} ms".format(end-start))
 
         prefix_len = prompts.shape[1]
+        if early_stop_num != -1:
+            max_len = prefix_len + int(early_stop_num[0])
+        else:
+            max_len = 10**9
 
         if args.benchmark:
             start = int(round(time.time() * 1000))
@@ -148,12 +171,42 @@ class T2SModel():
             end = int(round(time.time() * 1000))
             logger.info("\tfsdec processing time {} ms".format(end-start))
 
+        if args.onnx:
+            # keep kv cache as OrtValue between steps to avoid copying it back and forth
+            io_binding = self.sess_sdec.io_binding()
+            io_binding.bind_cpu_input("iy", y)
+            io_binding.bind_cpu_input("ik", k)
+            io_binding.bind_cpu_input("iv", v)
+            io_binding.bind_cpu_input("iy_emb", y_emb)
+            io_binding.bind_cpu_input("ix_example", x_example)
+            io_binding.bind_cpu_input("top_k", top_k)
+            io_binding.bind_cpu_input("top_p", top_p)
+            io_binding.bind_cpu_input("temperature", temperature)
+            io_binding.bind_cpu_input("repetition_penalty", repetition_penalty)
+            device = "cuda" if "CUDAExecutionProvider" in self.sess_sdec.get_providers() else "cpu"
+
         stop = False
         for idx in range(1, 1500):
             if args.benchmark:
                 start = int(round(time.time() * 1000))
             if args.onnx:
-                y, k, v, y_emb, logits, samples = self.sess_sdec.run(None, {"iy":y, "ik":k, "iv":v, "iy_emb":y_emb, "ix_example":x_example, "top_k":top_k, "top_p":top_p, "temperature":temperature, "repetition_penalty":repetition_penalty})
+                # y, kv cache and y_emb stay on the device, only the host side values are copied back
+                io_binding.bind_output("y", device, 0)
+                io_binding.bind_output("k", device, 0)
+                io_binding.bind_output("v", device, 0)
+                io_binding.bind_output("y_emb", device, 0)
+                io_binding.bind_output("logits", "cpu" if args.argmax_eos else device, 0)
+                io_binding.bind_output("samples", "cpu")
+                self.sess_sdec.run_with_iobinding(io_binding)
+                y, k, v, y_emb, logits, samples = io_binding.get_outputs()
+                io_binding.bind_ortvalue_input("iy", y)
+                io_binding.bind_ortvalue_input("ik", k)
+                io_binding.bind_ortvalue_input("iv", v)
+                io_binding.bind_ortvalue_input("iy_emb", y_emb)
+                samples = samples.numpy()
+                if args.argmax_eos:
+                    logits = logits.numpy()
+                y_len = y.shape()[1]
             else:
                 if idx == 1:
                     y, k, v, y_emb, logits, samples = self.sess_sdec.run({"iy":y, "ik":k, "iv":v, "iy_emb":y_emb, "ix_example":x_example, "top_k":top_k, "top_p":top_p, "temperature":temperature, "repetition_penalty":repetition_penalty})
@@ -183,21 +236,27 @@ class T2SModel():
                         k = self.sess_sdec.get_blob_data(output_blob_idx[1])
                         v = self.sess_sdec.get_blob_data(output_blob_idx[2])
                     y_emb = self.sess_sdec.get_blob_data(output_blob_idx[3])
-                    logits = self.sess_sdec.get_blob_data(output_blob_idx[4])
+                    if args.argmax_eos:
+                        logits = self.sess_sdec.get_blob_data(output_blob_idx[4])
                     samples = self.sess_sdec.get_blob_data(output_blob_idx[5])
+                y_len = y.shape[1]
     
             if args.benchmark:
                 end = int(round(time.time() * 1000))
                 logger.info("\tsdec processing time {} ms".format(end-start))
-            if early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num:
+            if y_len > max_len:
+                stop = True
+            if samples[0, 0] == EOS:
                 stop = True
-            if np.argmax(logits, axis=-1)[0] == EOS or samples[0, 0] == EOS:
+            elif args.argmax_eos and np.argmax(logits, axis=-1)[0] == EOS:
                 stop = True
             if stop:
                 break
+        if args.onnx:
+            y = y.numpy()
         y[0, -1] = 0
 
-        return y[np.newaxis, :, -idx:-1]
+        return np.ascontiguousarray(y[:, -idx:-1])[np.newaxis, ...]
 
 
 class GptSoVits():
@@ -248,6 +307,18 @@ class SSLModel():
         return last_hidden_state[0]
 
 
+def get_ref_cache_path():
+    # key on the reference audio content and everything that changes ref_seq and ssl_content
+    h = hashlib.sha1()
+    with open(args.ref_audio, 'rb') as f:
+        h.update(f.read())
+    h.update(args.ref_text.encode('utf-8'))
+    h.update(args.ref_language.encode('utf-8'))
+    h.update(b'ailia_voice' if args.ailia_voice else b'')
+    h.update(b'onnx' if args.onnx else b'')
+    return os.path.join(os.path.expanduser(REF_CACHE_DIR), h.hexdigest() + '.npz')
+
+
 def generate_voice(ssl, t2s_encoder, t2s_first_decoder, t2s_stage_decoder, vits):
     gpt = T2SModel(t2s_encoder, t2s_first_decoder, t2s_stage_decoder,)
     gpt_sovits = GptSoVits(gpt, vits)
@@ -263,18 +334,6 @@ def generate_voice(ssl, t2s_encoder, t2s_first_decoder, t2s_stage_decoder, vits)
         import text.japanese as japanese
         import text.english as english
 
-    if args.ref_language == "ja":
-        if args.ailia_voice:
-            ref_phones = voice.g2p(args.ref_text, ailia_voice.AILIA_VOICE_G2P_TYPE_GPT_SOVITS_JA).split(" ")[:-1]
-        else:
-            ref_phones = japanese.g2p(args.ref_text)
-    else:
-        if args.ailia_voice:
-            ref_phones = voice.g2p(args.ref_text, ailia_voice.AILIA_VOICE_G2P_TYPE_GPT_SOVITS_EN).split(" ")[:-1]
-        else:
-            ref_phones = english.g2p(args.ref_text)
-    ref_seq = np.array([cleaned_text_to_sequence(ref_phones)], dtype=np.int64)
-
     if args.text_language == "ja":
         if args.ailia_voice:
             text_phones = voice.g2p(args.input, ailia_voice.AILIA_VOICE_G2P_TYPE_GPT_SOVITS_JA).split(" ")[:-1]
@@ -287,25 +346,47 @@ def generate_voice(ssl, t2s_encoder, t2s_first_decoder, t2s_stage_decoder, vits)
             text_phones = english.g2p(args.input)
     text_seq = np.array([cleaned_text_to_sequence(text_phones)], dtype=np.int64)
 
-    # empty for ja or en
-    ref_bert = np.zeros((ref_seq.shape[1], 1024), dtype=np.float32)
-    text_bert = np.zeros((text_seq.shape[1], 1024), dtype=np.float32)
-    
     vits_hps_data_sampling_rate = 32000
 
-    zero_wav = np.zeros(
-        int(vits_hps_data_sampling_rate * 0.3),
-        dtype=np.float32,
-    )
-    wav16k, sr = librosa.load(input_audio, sr=16000)
-    wav16k = np.concatenate([wav16k, zero_wav], axis=0)
-    wav16k = wav16k[np.newaxis, :]
-    ref_audio_16k = wav16k # hubertの入力のみpaddingする
+    cache_path = get_ref_cache_path() if args.ref_cache else None
+    if cache_path is not None and os.path.exists(cache_path):
+        logger.info(f'load reference cache : {cache_path}')
+        with np.load(cache_path) as ref_cache:
+            ref_seq = ref_cache['ref_seq']
+            wav32k = ref_cache['wav32k']
+            ssl_content = ref_cache['ssl_content']
+    else:
+        if args.ref_language == "ja":
+            if args.ailia_voice:
+                ref_phones = voice.g2p(args.ref_text, ailia_voice.AILIA_VOICE_G2P_TYPE_GPT_SOVITS_JA).split(" ")[:-1]
+            else:
+                ref_phones = japanese.g2p(args.ref_text)
+        else:
+            if args.ailia_voice:
+                ref_phones = voice.g2p(args.ref_text, ailia_voice.AILIA_VOICE_G2P_TYPE_GPT_SOVITS_EN).split(" ")[:-1]
+            else:
+                ref_phones = english.g2p(args.ref_text)
+        ref_seq = np.array([cleaned_text_to_sequence(ref_phones)], dtype=np.int64)
 
-    wav32k, sr = librosa.load(input_audio, sr=vits_hps_data_sampling_rate)
-    wav32k = wav32k[np.newaxis, :]
+        wav32k, sr = librosa.load(input_audio, sr=vits_hps_data_sampling_rate)
+        wav16k = librosa.resample(wav32k, orig_sr=sr, target_sr=16000)
+        # hubertの入力のみpaddingする
+        pad = int(vits_hps_data_sampling_rate * 0.3)
+        ref_audio_16k = np.zeros((1, wav16k.shape[0] + pad), dtype=np.float32)
+        ref_audio_16k[0, :wav16k.shape[0]] = wav16k
 
-    ssl_content = ssl.forward(ref_audio_16k)
+        wav32k = wav32k[np.newaxis, :]
+
+        ssl_content = ssl.forward(ref_audio_16k)
+
+        if cache_path is not None:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            np.savez(cache_path, ref_seq=ref_seq, wav32k=wav32k, ssl_content=ssl_content)
+            logger.info(f'saved reference cache : {cache_path}')
+
+    # empty for ja or en
+    ref_bert = np.zeros((ref_seq.shape[1], 1024), dtype=np.float32)
+    text_bert = np.zeros((text_seq.shape[1], 1024), dtype=np.float32)
 
     a = gpt_sovits.forward(ref_seq, text_seq, ref_bert, text_bert, wav32k, ssl_content)
 
@@ -317,6 +398,15 @@ def generate_voice(ssl, t2s_encoder, t2s_first_decoder, t2s_stage_decoder, vits)
     logger.info('Script finished successfully.')
 
 
+def int8_weight_path(weight_path):
+    # prefer the model quantized by export/quantize_gpt_sovits.py if it exists
+    int8_path = weight_path.replace('.onnx', '_int8.onnx')
+    if os.path.exists(int8_path):
+        logger.info(f'use int8 model : {int8_path}')
+        return int8_path
+    return weight_path
+
+
 def main():
     # model files check and download
     check_and_download_models(WEIGHT_PATH_SSL, MODEL_PATH_SSL, REMOTE_PATH)
@@ -327,15 +417,38 @@ def main():
 
     #env_id = args.env_id
 
+    if args.tensorrt and not args.onnx:
+        logger.warning('--tensorrt is only used with --onnx.')
+
     if args.onnx:
         import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.enable_mem_pattern = True
+        options.enable_cpu_mem_arena = True
+        options.intra_op_num_threads = max(1, (os.cpu_count() or 1) // 2)
+        available_providers = onnxruntime.get_available_providers()
         providers = ["CPUExecutionProvider"]
-        #providers = ["CUDAExecutionProvider"]
-        ssl = onnxruntime.InferenceSession(WEIGHT_PATH_SSL, providers=providers)
-        t2s_encoder = onnxruntime.InferenceSession(WEIGHT_PATH_T2S_ENCODER, providers=providers)
-        t2s_first_decoder = onnxruntime.InferenceSession(WEIGHT_PATH_T2S_FIRST_DECODER, providers=providers)
-        t2s_stage_decoder = onnxruntime.InferenceSession(WEIGHT_PATH_T2S_STAGE_DECODER, providers=providers)
-        vits = onnxruntime.InferenceSession(WEIGHT_PATH_VITS, providers=providers)
+        if "CUDAExecutionProvider" in available_providers:
+            providers.insert(0, ("CUDAExecutionProvider", {
+                "cudnn_conv_algo_search": "DEFAULT",
+                "arena_extend_strategy": "kSameAsRequested",
+            }))
+        if args.tensorrt and "TensorrtExecutionProvider" in available_providers:
+            # the engine is built on the first run and loaded from the cache after that
+            providers.insert(0, ("TensorrtExecutionProvider", {
+                "trt_fp16_enable": True,
+                "trt_engine_cache_enable": True,
+                "trt_engine_cache_path": TRT_CACHE_PATH,
+            }))
+        elif args.tensorrt:
+            logger.warning('TensorrtExecutionProvider is not available.')
+        ssl = onnxruntime.InferenceSession(WEIGHT_PATH_SSL, sess_options=options, providers=providers)
+        t2s_encoder = onnxruntime.InferenceSession(int8_weight_path(WEIGHT_PATH_T2S_ENCODER), sess_options=options, providers=providers)
+        t2s_first_decoder = onnxruntime.InferenceSession(int8_weight_path(WEIGHT_PATH_T2S_FIRST_DECODER), sess_options=options, providers=providers)
+        t2s_stage_decoder = onnxruntime.InferenceSession(int8_weight_path(WEIGHT_PATH_T2S_STAGE_DECODER), sess_options=options, providers=providers)
+        vits = onnxruntime.InferenceSession(int8_weight_path(WEIGHT_PATH_VITS), sess_options=options, providers=providers)
     else:
         import ailia
         memory_mode = ailia.get_memory_mode(reduce_constant=True, ignore_input_with_initializer=True, reduce_interstage=False, reuse_interstage=True)
@@ -270,11 +270,10 @@ mel_filters = mel_filter_bank(
     norm="slaney",
     mel_scale="slaney",
 )
+window = window_function(N_FFT, "hann")
 
 
 def extract_fbank_features(waveform_batch: np.array):
-    window = window_function(N_FFT, "hann")
-
     log_spec_batch = []
     for i, waveform in enumerate(waveform_batch):
         log_spec = spectrogram(
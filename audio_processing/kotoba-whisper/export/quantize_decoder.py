@@ -0,0 +1,128 @@
+# Dynamic int8 quantization of the Kotoba-Whisper decoder.
+# Run from the kotoba-whisper directory after kotoba-whisper.py has downloaded the models:
+#   python3 export/quantize_decoder.py
+# kotoba-whisper.py --onnx --int8 then loads kotoba-whisper-v1.0_decoder_int8.onnx.
+
+import os
+import argparse
+
+import numpy as np
+import onnx
+from onnx import AttributeProto, TensorProto, helper, numpy_helper
+from onnxruntime.quantization import quantize_dynamic, QuantType
+
+WEIGHT_DEC_PATH = "kotoba-whisper-v1.0_decoder.onnx"
+WEIGHT_DEC_INT8_PATH = "kotoba-whisper-v1.0_decoder_int8.onnx"
+
+parser = argparse.ArgumentParser(description="Kotoba-Whisper decoder int8 quantization")
+parser.add_argument(
+    "--model_dir", default=".",
+    help="directory containing the downloaded onnx models"
+)
+args = parser.parse_args()
+
+
+def tensor_to_float32(tensor):
+    arr = numpy_helper.to_array(tensor).astype(np.float32)
+    tensor.CopyFrom(numpy_helper.from_array(arr, tensor.name))
+
+
+def set_float32(value_infos):
+    for vi in value_infos:
+        if vi.type.tensor_type.elem_type == TensorProto.FLOAT16:
+            vi.type.tensor_type.elem_type = TensorProto.FLOAT
+
+
+def graph_to_float32(graph, subgraph=False):
+    if subgraph:
+        set_float32(graph.input)
+        set_float32(graph.output)
+    for init in graph.initializer:
+        if init.data_type == TensorProto.FLOAT16:
+            tensor_to_float32(init)
+    for node in graph.node:
+        for attr in node.attribute:
+            if attr.type == AttributeProto.TENSOR:
+                if attr.t.data_type == TensorProto.FLOAT16:
+                    tensor_to_float32(attr.t)
+            elif attr.type == AttributeProto.GRAPH:
+                graph_to_float32(attr.g, subgraph=True)
+            elif attr.type == AttributeProto.GRAPHS:
+                for g in attr.graphs:
+                    graph_to_float32(g, subgraph=True)
+            elif (
+                node.op_type == "Cast"
+                and attr.name == "to"
+                and attr.i == TensorProto.FLOAT16
+            ):
+                attr.i = TensorProto.FLOAT
+    set_float32(graph.value_info)
+
+
+def rename_tensor(graph, old, new):
+    for node in graph.node:
+        for i, name in enumerate(node.input):
+            if name == old:
+                node.input[i] = new
+        for i, name in enumerate(node.output):
+            if name == old:
+                node.output[i] = new
+        # subgraphs may refer to the outer tensors
+        for attr in node.attribute:
+            if attr.type == AttributeProto.GRAPH:
+                rename_tensor(attr.g, old, new)
+            elif attr.type == AttributeProto.GRAPHS:
+                for g in attr.graphs:
+                    rename_tensor(g, old, new)
+
+
+def model_to_float32(model):
+    """
+    Compute the graph in fp32, keeping the fp16 inputs and outputs (kv cache) with casts.
+    The dynamic quantizer inserts DynamicQuantizeLinear, which only takes fp32.
+    """
+    graph = model.graph
+    graph_to_float32(graph)
+
+    # fp16 graph inputs -> Cast -> fp32, fp32 -> Cast -> fp16 graph outputs
+    input_casts = []
+    for inp in graph.input:
+        if inp.type.tensor_type.elem_type == TensorProto.FLOAT16:
+            rename_tensor(graph, inp.name, inp.name + "_fp32")
+            input_casts.append(
+                helper.make_node(
+                    "Cast", [inp.name], [inp.name + "_fp32"], to=TensorProto.FLOAT
+                )
+            )
+    output_casts = []
+    for out in graph.output:
+        if out.type.tensor_type.elem_type == TensorProto.FLOAT16:
+            rename_tensor(graph, out.name, out.name + "_fp32")
+            output_casts.append(
+                helper.make_node(
+                    "Cast", [out.name + "_fp32"], [out.name], to=TensorProto.FLOAT16
+                )
+            )
+    # keep the node list topologically sorted
+    nodes = input_casts + list(graph.node) + output_casts
+    del graph.node[:]
+    graph.node.extend(nodes)
+
+    return model
+
+
+def main():
+    src = os.path.join(args.model_dir, WEIGHT_DEC_PATH)
+    dst = os.path.join(args.model_dir, WEIGHT_DEC_INT8_PATH)
+
+    model = model_to_float32(onnx.load(src))
+    quantize_dynamic(
+        model, dst,
+        weight_type=QuantType.QInt8,
+        op_types_to_quantize=["MatMul", "Gemm"],
+    )
+    print("saved " + dst)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,12 @@
+import os
 import sys
 import time
 from typing import List
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 
 import numpy as np
-from scipy.special import log_softmax, logsumexp
+from scipy.special import logsumexp
 import librosa
 
 
@@ -30,6 +32,7 @@ WEIGHT_ENC_PB_PATH = "kotoba-whisper-v1.0_encoder_weights.pb"
 MODEL_ENC_PATH = "kotoba-whisper-v1.0_encoder.onnx.prototxt"
 WEIGHT_DEC_PATH = "kotoba-whisper-v1.0_decoder.onnx"
 MODEL_DEC_PATH = "kotoba-whisper-v1.0_decoder.onnx.prototxt"
+WEIGHT_DEC_INT8_PATH = "kotoba-whisper-v1.0_decoder_int8.onnx"
 REMOTE_PATH = "https://storage.googleapis.com/ailia-models/kotoba-whisper/"
 
 WAV_PATH = "demo.wav"
@@ -37,6 +40,50 @@ SAVE_TEXT_PATH = "output.txt"
 
 flg_ffmpeg = False
 
+VOCAB_SIZE = 51866
+NEG_INF = np.float32(-np.inf)
+
+# fmt: off
+SUPPRESS_TOKENS = [
+    1,     2,     7,     8,     9,     10,    14,    25,    26,    27,
+    28,    29,    31,    58,    59,    60,    61,    62,    63,    90,
+    91,    92,    93,    359,   503,   522,   542,   873,   893,   902,
+    918,   922,   931,   1350,  1853,  1982,  2460,  2627,  3246,  3253,
+    3268,  3536,  3846,  3961,  4183,  4667,  6585,  6647,  7273,  9061,
+    9383,  10428, 10929, 11938, 12033, 12331, 12562, 13793, 14157, 14635,
+    15265, 15618, 16553, 16604, 18362, 18956, 20075, 21675, 22520, 26130,
+    26161, 26435, 28279, 29464, 31650, 32302, 32470, 36865, 42863, 47425,
+    49870, 50254, 50258, 50359, 50360, 50361, 50362, 50363
+]
+# fmt: on
+BEGIN_SUPPRESS_TOKENS = [220, 50257]
+NO_TIMESTAMPS_TOKEN_ID = 50364
+TIMESTAMP_BEGIN = 50365
+MAX_INITIAL_TIMESTAMP_INDEX = 50
+
+# SuppressTokensLogitsProcessor and <|notimestamps|> of WhisperTimeStampLogitsProcessor
+SUPPRESS_MASK = np.zeros(VOCAB_SIZE, dtype=bool)
+SUPPRESS_MASK[SUPPRESS_TOKENS] = True
+SUPPRESS_MASK[NO_TIMESTAMPS_TOKEN_ID] = True
+
+# on the first generated token, SuppressTokensAtBeginLogitsProcessor
+# and the `max_initial_timestamp` option as well
+BEGIN_SUPPRESS_MASK = SUPPRESS_MASK.copy()
+BEGIN_SUPPRESS_MASK[BEGIN_SUPPRESS_TOKENS] = True
+BEGIN_SUPPRESS_MASK[:TIMESTAMP_BEGIN] = True
+BEGIN_SUPPRESS_MASK[TIMESTAMP_BEGIN + MAX_INITIAL_TIMESTAMP_INDEX + 1 :] = True
+
+PAST_KEY_VALUES_NAMES = [
+    "past_key_values.0.decoder.key",
+    "past_key_values.0.decoder.value",
+    "past_key_values.0.encoder.key",
+    "past_key_values.0.encoder.value",
+    "past_key_values.1.decoder.key",
+    "past_key_values.1.decoder.value",
+    "past_key_values.1.encoder.key",
+    "past_key_values.1.encoder.value",
+]
+
 # ======================
 # Arguemnt Parser Config
 # ======================
@@ -51,7 +98,8 @@ parser.add_argument(
     "--batch_size",
     type=int,
     default=1,
-    help="the size of the batch to use, for inference.",
+    help="the size of the batch to use, for inference. "
+    "0 runs all chunks of --chunk_length in a single batch.",
 )
 parser.add_argument(
     '--disable_ailia_tokenizer',
@@ -60,6 +108,11 @@ parser.add_argument(
 )
 parser.add_argument("--memory_mode", default=-1, type=int, help="memory mode")
 parser.add_argument("--onnx", action="store_true", help="execute onnxruntime version.")
+parser.add_argument(
+    "--int8",
+    action="store_true",
+    help="use the int8 decoder made by export/quantize_decoder.py (onnxruntime only).",
+)
 args = update_parser(parser, check_input_type=False)
 
 
@@ -182,6 +235,7 @@ def decode(
     encoder_hidden_states: np.ndarray,
     input_ids: np.ndarray,
     past_key_values: List[np.ndarray],
+    io_binding=None,
 ):
     if args.benchmark:
         start = int(round(time.time() * 1000))
@@ -202,21 +256,25 @@ def decode(
             ]
         )
     else:
-        decoder_output = net.run(
-            None,
-            {
-                "input_ids": input_ids,
-                "encoder_hidden_states": encoder_hidden_states,
-                "past_key_values.0.decoder.key": past_key_values[0],
-                "past_key_values.0.decoder.value": past_key_values[1],
-                "past_key_values.0.encoder.key": past_key_values[2],
-                "past_key_values.0.encoder.value": past_key_values[3],
-                "past_key_values.1.decoder.key": past_key_values[4],
-                "past_key_values.1.decoder.value": past_key_values[5],
-                "past_key_values.1.encoder.key": past_key_values[6],
-                "past_key_values.1.encoder.value": past_key_values[7],
-            },
-        )
+        # encoder_hidden_states is bound once by greedy_search,
+        # past_key_values are the OrtValues returned by the previous step
+        io_binding.bind_cpu_input("input_ids", input_ids)
+        for name, value in zip(PAST_KEY_VALUES_NAMES, past_key_values):
+            if isinstance(value, np.ndarray):
+                io_binding.bind_cpu_input(name, value)
+            else:
+                io_binding.bind_ortvalue_input(name, value)
+
+        # kv cache stays on the device of the session, only logits come back
+        device = "cuda" if "CUDAExecutionProvider" in net.get_providers() else "cpu"
+        output_names = [output.name for output in net.get_outputs()]
+        io_binding.bind_output(output_names[0], "cpu")
+        for name in output_names[1:]:
+            io_binding.bind_output(name, device)
+        net.run_with_iobinding(io_binding)
+
+        decoder_output = io_binding.get_outputs()
+        decoder_output = [decoder_output[0].numpy()] + decoder_output[1:]
 
     if args.benchmark:
         end = int(round(time.time() * 1000))
@@ -228,45 +286,34 @@ def decode(
     return logits, new_past_key_values
 
 
-def stopping_criteria(input_ids: np.array) -> bool:
-    is_done = np.full((input_ids.shape[0],), False)
-
-    # MaxLengthCriteria
-    max_length = 448
-    cur_len = input_ids.shape[-1]
-    is_done = is_done | cur_len >= max_length
-
-    # EosTokenCriteria
-    eos_token_id = 50257
-    is_done = is_done | np.isin(input_ids[:, -1], [eos_token_id])
-
-    return is_done
-
-
 def greedy_search(net, input_ids, encoder_hidden_states):
     pad_token_id = 50257
-    suppress_tokens = [
-        # fmt: off
-        1,     2,     7,     8,     9,     10,    14,    25,    26,    27,
-        28,    29,    31,    58,    59,    60,    61,    62,    63,    90,
-        91,    92,    93,    359,   503,   522,   542,   873,   893,   902,
-        918,   922,   931,   1350,  1853,  1982,  2460,  2627,  3246,  3253,
-        3268,  3536,  3846,  3961,  4183,  4667,  6585,  6647,  7273,  9061,
-        9383,  10428, 10929, 11938, 12033, 12331, 12562, 13793, 14157, 14635,
-        15265, 15618, 16553, 16604, 18362, 18956, 20075, 21675, 22520, 26130,
-        26161, 26435, 28279, 29464, 31650, 32302, 32470, 36865, 42863, 47425,
-        49870, 50254, 50258, 50359, 50360, 50361, 50362, 50363
-        # fmt: on
-    ]
     begin_index = 3
-    begin_suppress_tokens = [220, 50257]
-    no_timestamps_token_id = 50364
-    timestamp_begin = 50365
     eos_token_id = 50257
-    max_initial_timestamp_index = 50
+    max_length = 448
 
     batch_size, cur_len = input_ids.shape
+
+    # generated ids are written in place, input_ids is a view of the filled part
+    input_ids_buf = np.empty((batch_size, max_length), dtype=input_ids.dtype)
+    input_ids_buf[:, :cur_len] = input_ids
+    input_ids = input_ids_buf[:, :cur_len]
+
     past_key_values = [np.zeros((batch_size, 20, 0, 64), dtype=np.float16)] * 8
+    past_length = 0
+
+    io_binding = None
+    if args.onnx:
+        io_binding = net.io_binding()
+        io_binding.bind_cpu_input("encoder_hidden_states", encoder_hidden_states)
+
+    # last timestamp token sampled per sequence (-1 if none yet)
+    sampled_tokens = input_ids[:, begin_index:]
+    last_timestamp = np.max(
+        np.where(sampled_tokens >= TIMESTAMP_BEGIN, sampled_tokens, -1),
+        axis=-1,
+        initial=-1,
+    )
 
     # keep track of which sequences are already finished
     this_peer_finished = False
@@ -274,8 +321,7 @@ def greedy_search(net, input_ids, encoder_hidden_states):
 
     while not this_peer_finished:
         # prepare model inputs
-        past_length = past_key_values[0].shape[2]
-        decoder_input_ids = input_ids[:, past_length:]
+        decoder_input_ids = np.ascontiguousarray(input_ids[:, past_length:])
 
         # forward pass to get next token
         logits, past_key_values = decode(
@@ -283,58 +329,48 @@ def greedy_search(net, input_ids, encoder_hidden_states):
             encoder_hidden_states,
             decoder_input_ids,
             past_key_values,
+            io_binding=io_binding,
         )
-        next_tokens_scores = logits[:, -1, :]
+        past_length = input_ids.shape[1]
+        next_tokens_scores = np.ascontiguousarray(logits[:, -1, :], dtype=np.float32)
 
-        # SuppressTokensLogitsProcessor
-        next_tokens_scores[:, suppress_tokens] = -float("inf")
-        # SuppressTokensAtBeginLogitsProcessor
         if input_ids.shape[1] == begin_index:
-            next_tokens_scores[:, begin_suppress_tokens] = -float("inf")
+            next_tokens_scores[:, BEGIN_SUPPRESS_MASK] = NEG_INF
+        else:
+            next_tokens_scores[:, SUPPRESS_MASK] = NEG_INF
 
-        # WhisperTimeStampLogitsProcessor
-        next_tokens_scores[:, no_timestamps_token_id] = -float("inf")
         # timestamps have to appear in pairs, except directly before eos_token; mask logits accordingly
-        for k in range(input_ids.shape[0]):
-            sampled_tokens = input_ids[k, begin_index:]
-            seq = sampled_tokens.tolist()
-
-            last_was_timestamp = len(seq) >= 1 and seq[-1] >= timestamp_begin
-            penultimate_was_timestamp = len(seq) < 2 or seq[-2] >= timestamp_begin
-
-            if last_was_timestamp:
-                if penultimate_was_timestamp:  # has to be non-timestamp
-                    next_tokens_scores[k, timestamp_begin:] = -float("inf")
-                else:  # cannot be normal text tokens
-                    next_tokens_scores[k, :eos_token_id] = -float("inf")
-
-            timestamps = sampled_tokens[
-                np.greater_equal(sampled_tokens, timestamp_begin)
-            ]
-            if timestamps.size > 0:
-                # `timestamps` shouldn't decrease; forbid timestamp tokens smaller than the last
-                # The following lines of code are copied from: https://github.com/openai/whisper/pull/914/files#r1137085090
-                if last_was_timestamp and not penultimate_was_timestamp:
-                    timestamp_last = timestamps[-1]
-                else:
-                    # Avoid to emit <|0.00|> again
-                    timestamp_last = timestamps[-1] + 1
+        seq_len = input_ids.shape[1] - begin_index
+        last_was_timestamp = np.full(batch_size, seq_len >= 1)
+        penultimate_was_timestamp = np.full(batch_size, seq_len < 2)
+        if seq_len >= 1:
+            last_was_timestamp &= input_ids[:, -1] >= TIMESTAMP_BEGIN
+        if seq_len >= 2:
+            penultimate_was_timestamp |= input_ids[:, -2] >= TIMESTAMP_BEGIN
+
+        for k in np.flatnonzero(last_was_timestamp):
+            if penultimate_was_timestamp[k]:  # has to be non-timestamp
+                next_tokens_scores[k, TIMESTAMP_BEGIN:] = NEG_INF
+            else:  # cannot be normal text tokens
+                next_tokens_scores[k, :eos_token_id] = NEG_INF
+
+        # `timestamps` shouldn't decrease; forbid timestamp tokens smaller than the last
+        # The following lines of code are copied from: https://github.com/openai/whisper/pull/914/files#r1137085090
+        for k in np.flatnonzero(last_timestamp >= 0):
+            if last_was_timestamp[k] and not penultimate_was_timestamp[k]:
+                timestamp_last = last_timestamp[k]
+            else:
+                # Avoid to emit <|0.00|> again
+                timestamp_last = last_timestamp[k] + 1
 
-                next_tokens_scores[k, timestamp_begin:timestamp_last] = -float("inf")
-        # apply the `max_initial_timestamp` option
-        if input_ids.shape[1] == begin_index:
-            next_tokens_scores[:, :timestamp_begin] = -float("inf")
+            next_tokens_scores[k, TIMESTAMP_BEGIN:timestamp_last] = NEG_INF
 
-            if max_initial_timestamp_index is not None:
-                last_allowed = timestamp_begin + max_initial_timestamp_index
-                next_tokens_scores[:, last_allowed + 1 :] = -float("inf")
         # if sum of probability over timestamps is above any other token, sample timestamp
-        logprobs = log_softmax(next_tokens_scores, axis=-1)
-        for k in range(input_ids.shape[0]):
-            timestamp_logprob = logsumexp(logprobs[k, timestamp_begin:], axis=-1)
-            max_text_token_logprob = np.max(logprobs[k, :timestamp_begin])
-            if timestamp_logprob > max_text_token_logprob:
-                next_tokens_scores[k, :timestamp_begin] = -float("inf")
+        # log_softmax shifts both sides by the same constant, so compare the raw scores
+        timestamp_logprob = logsumexp(next_tokens_scores[:, TIMESTAMP_BEGIN:], axis=-1)
+        max_text_token_logprob = np.max(next_tokens_scores[:, :TIMESTAMP_BEGIN], axis=-1)
+        sample_timestamp = timestamp_logprob > max_text_token_logprob
+        next_tokens_scores[sample_timestamp, :TIMESTAMP_BEGIN] = NEG_INF
 
         # argmax
         next_tokens = np.argmax(next_tokens_scores, axis=-1)
@@ -345,39 +381,52 @@ def greedy_search(net, input_ids, encoder_hidden_states):
         )
 
         # update generated ids, model inputs, and length for next step
-        input_ids = np.concatenate([input_ids, next_tokens[:, None]], axis=-1)
+        input_ids_buf[:, cur_len] = next_tokens
+        cur_len += 1
+        input_ids = input_ids_buf[:, :cur_len]
+        last_timestamp = np.where(
+            next_tokens >= TIMESTAMP_BEGIN, next_tokens, last_timestamp
+        )
 
-        is_stopping = stopping_criteria(input_ids)
-        unfinished_sequences = unfinished_sequences & ~is_stopping
-        if np.max(unfinished_sequences) == 0:
+        # MaxLengthCriteria, EosTokenCriteria
+        is_stopping = (cur_len >= max_length) | (next_tokens == eos_token_id)
+        unfinished_sequences &= ~is_stopping
+        if not unfinished_sequences.any():
             this_peer_finished = True
 
     return input_ids
 
 
-def forward(models, input_features):
+def encode(models, input_features):
     if args.benchmark:
         start = int(round(time.time() * 1000))
 
-    # encoder
     net = models["enc"]
     if not args.onnx:
         output = net.run(input_features)
     else:
         output = net.run(None, {"input_features": input_features})
     last_hidden_state = output[0]
-    last_hidden_state = last_hidden_state.astype(np.float16)
+    last_hidden_state = last_hidden_state.astype(np.float16, copy=False)
 
     if args.benchmark:
         end = int(round(time.time() * 1000))
         estimation_time = end - start
         logger.info(f"\tencoder processing time {estimation_time} ms")
 
+    return last_hidden_state
+
+
+def forward(models, input_features, last_hidden_state=None):
+    # encoder
+    if last_hidden_state is None:
+        last_hidden_state = encode(models, input_features)
+
     # language: japanese
     # task: transcribe
     init_tokens = np.array([[50258, 50266, 50360]])
 
-    batch_size = input_features.shape[0]
+    batch_size = last_hidden_state.shape[0]
     decoder_input_ids = np.repeat(init_tokens[:, ...], batch_size, axis=0)
 
     net = models["dec"]
@@ -386,14 +435,19 @@ def forward(models, input_features):
     return outputs
 
 
-def generate(models, input_features):
+def generate(models, input_features, last_hidden_state=None):
     num_segment_frames = 3000
-    total_input_frames = input_features.shape[-1]
-    is_shortform = total_input_frames <= num_segment_frames
+    # only short-form input comes encoded, its features are already released
+    is_shortform = (
+        last_hidden_state is not None
+        or input_features.shape[-1] <= num_segment_frames
+    )
 
     if is_shortform:
-        outputs = forward(models, input_features)
+        outputs = forward(models, input_features, last_hidden_state)
     else:
+        total_input_frames = input_features.shape[-1]
+
         # global generate variables
         time_precision = 0.02
         input_stride = 2
@@ -580,33 +634,53 @@ def generate(models, input_features):
 
 def predict(models, audio, chunk_length_s=0):
     batch_size = args.batch_size
+    if batch_size <= 0:
+        # accumulate every chunk and run them as one batch below
+        batch_size = float("inf")
 
     processed = preprocess(audio, chunk_length_s)
 
-    model_outputs = []
-
     # pack_iter
-    accumulator = []
-    for item in processed:
-        accumulator.append(item)
-        if batch_size <= len(accumulator):
-            input_features = np.concatenate(
-                [item.pop("input_features") for item in accumulator], axis=0
-            )
-            tokens = generate(models, input_features)
-            for i, item in enumerate(accumulator):
-                item["tokens"] = tokens[i : i + 1]
-                model_outputs.append(item)
-            accumulator.clear()
-
-    if 0 < len(accumulator):
+    def pack_iter():
+        accumulator = []
+        for item in processed:
+            accumulator.append(item)
+            if batch_size <= len(accumulator):
+                yield accumulator
+                accumulator = []
+        if 0 < len(accumulator):
+            yield accumulator
+
+    batches = pack_iter()
+
+    def encode_next():
+        batch = next(batches, None)
+        if batch is None:
+            return None
         input_features = np.concatenate(
-            [item.pop("input_features") for item in accumulator], axis=0
+            [item.pop("input_features") for item in batch], axis=0
         )
-        tokens = generate(models, input_features)
-        for i, item in enumerate(accumulator):
-            item["tokens"] = tokens[i : i + 1]
-            model_outputs.append(item)
+        # long-form input is encoded per 30s segment inside generate
+        if input_features.shape[-1] > 3000:
+            return batch, input_features, None
+        # the features are not kept once encoded
+        return batch, None, encode(models, input_features)
+
+    # extract and encode the next batch while the current batch is decoded
+    model_outputs = []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(encode_next)
+        while True:
+            result = future.result()
+            if result is None:
+                break
+            future = executor.submit(encode_next)
+
+            batch, input_features, last_hidden_state = result
+            tokens = generate(models, input_features, last_hidden_state)
+            for i, item in enumerate(batch):
+                item["tokens"] = tokens[i : i + 1]
+                model_outputs.append(item)
 
     if chunk_length_s:
         for item in model_outputs:
@@ -674,6 +748,9 @@ def main():
 
     env_id = args.env_id
 
+    if args.int8 and not args.onnx:
+        logger.warning("--int8 is only supported with --onnx, use the fp decoder.")
+
     # initialize
     if not args.onnx:
         if args.memory_mode == -1:
@@ -696,7 +773,16 @@ def main():
 
         providers = ["CUDAExecutionProvider", "CPUExecutionProvider"]
         enc_net = onnxruntime.InferenceSession(WEIGHT_ENC_PATH, providers=providers)
-        dec_net = onnxruntime.InferenceSession(WEIGHT_DEC_PATH, providers=providers)
+        dec_path = WEIGHT_DEC_PATH
+        if args.int8:
+            if os.path.exists(WEIGHT_DEC_INT8_PATH):
+                dec_path = WEIGHT_DEC_INT8_PATH
+            else:
+                logger.warning(
+                    "%s not found, use the fp decoder. "
+                    "Run export/quantize_decoder.py to create it." % WEIGHT_DEC_INT8_PATH
+                )
+        dec_net = onnxruntime.InferenceSession(dec_path, providers=providers)
 
     if args.disable_ailia_tokenizer:
         from transformers import WhisperTokenizerFast
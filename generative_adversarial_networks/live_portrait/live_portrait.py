@@ -1,10 +1,11 @@
 import os
 import sys
 import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import cv2
-from skimage import transform as sk_trans
 
 import ailia
 
@@ -13,7 +14,6 @@ sys.path.append("../../util")
 from arg_utils import get_base_parser, update_parser  # noqa
 from model_utils import check_and_download_models  # noqa
 from detector_utils import load_image  # noqa
-from nms_utils import nms_boxes
 from math_utils import softmax
 from load_model import load_facemesh_v2
 from webcamera_utils import get_capture, get_writer  # noqa
@@ -25,6 +25,11 @@ from logging import getLogger  # noqa
 
 
 PI = np.pi
+# bins of the head pose classifiers in degrees (3 degrees each, from -97.5)
+POSE_BINS = np.arange(66, dtype=np.float32) * 3 - 97.5
+# input normalization of the insightface detector
+DET_INPUT_MEAN = np.float32(127.5)
+DET_INPUT_SCALE = np.float32(1 / 128)
 
 top_path = os.path.dirname(
     os.path.dirname(
@@ -96,9 +101,19 @@ parser.add_argument(
     action="store_true",
     help="Don't display perview in GUI.",
 )
+parser.add_argument(
+    "--batch_size",
+    type=int,
+    default=1,
+    help="Number of driving frames generated together "
+    "(the output is delayed by up to this many frames).",
+)
 parser.add_argument("--onnx", action="store_true", help="execute onnxruntime version.")
 args = update_parser(parser)
 
+if args.onnx:
+    import onnxruntime
+
 
 # ======================
 # Secondary Functions
@@ -106,16 +121,14 @@ args = update_parser(parser)
 
 
 def distance2bbox(points, distance, max_shape=None):
-    x1 = points[:, 0] - distance[:, 0]
-    y1 = points[:, 1] - distance[:, 1]
-    x2 = points[:, 0] + distance[:, 2]
-    y2 = points[:, 1] + distance[:, 3]
+    out = np.empty(distance.shape[:1] + (4,), dtype=distance.dtype)
+    # (x1, y1) = point - (left, top), (x2, y2) = point + (right, bottom)
+    np.subtract(points, distance[:, 0:2], out=out[:, 0:2])
+    np.add(points, distance[:, 2:4], out=out[:, 2:4])
     if max_shape is not None:
-        x1 = x1.clamp(min=0, max=max_shape[1])
-        y1 = y1.clamp(min=0, max=max_shape[0])
-        x2 = x2.clamp(min=0, max=max_shape[1])
-        y2 = y2.clamp(min=0, max=max_shape[0])
-    return np.stack([x1, y1, x2, y2], axis=-1)
+        np.clip(out[:, 0::2], 0, max_shape[1], out=out[:, 0::2])
+        np.clip(out[:, 1::2], 0, max_shape[0], out=out[:, 1::2])
+    return out
 
 
 def distance2kps(points, distance, max_shape=None):
@@ -130,52 +143,67 @@ def distance2kps(points, distance, max_shape=None):
     Returns:
         Tensor: Decoded bboxes.
     """
-    preds = []
-    for i in range(0, distance.shape[1], 2):
-        px = points[:, i % 2] + distance[:, i]
-        py = points[:, i % 2 + 1] + distance[:, i + 1]
-        if max_shape is not None:
-            px = px.clamp(min=0, max=max_shape[1])
-            py = py.clamp(min=0, max=max_shape[0])
-        preds.append(px)
-        preds.append(py)
-    return np.stack(preds, axis=-1)
+    # explicit number of points, n can be 0 when no anchor is above the threshold
+    n, num_points = distance.shape[0], distance.shape[1] // 2
+    out = np.empty(distance.shape, dtype=distance.dtype)
+    preds = out.reshape(n, num_points, 2)
+    np.add(points[:, None, 0:2], distance.reshape(n, num_points, 2), out=preds)
+    if max_shape is not None:
+        np.clip(preds[:, :, 0], 0, max_shape[1], out=preds[:, :, 0])
+        np.clip(preds[:, :, 1], 0, max_shape[0], out=preds[:, :, 1])
+    return out
+
+
+def nms(dets, thresh):
+    """greedy NMS, dets (x1, y1, x2, y2, score) are sorted by score"""
+    x1 = dets[:, 0]
+    y1 = dets[:, 1]
+    x2 = dets[:, 2]
+    y2 = dets[:, 3]
+
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = np.arange(dets.shape[0])
+
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        xx1 = np.maximum(x1[i], x1[order[1:]])
+        yy1 = np.maximum(y1[i], y1[order[1:]])
+        xx2 = np.minimum(x2[i], x2[order[1:]])
+        yy2 = np.minimum(y2[i], y2[order[1:]])
+
+        w = np.maximum(0.0, xx2 - xx1 + 1)
+        h = np.maximum(0.0, yy2 - yy1 + 1)
+        inter = w * h
+        ovr = inter / (areas[i] + areas[order[1:]] - inter)
+
+        inds = np.where(ovr < thresh)[0]
+        order = order[inds + 1]
+
+    return np.array(keep, dtype=int)
 
 
 def face_align(data, center, output_size, scale, rotation):
     scale_ratio = scale
     rot = float(rotation) * np.pi / 180.0
 
-    t1 = sk_trans.SimilarityTransform(scale=scale_ratio)
-    cx = center[0] * scale_ratio
-    cy = center[1] * scale_ratio
-    t2 = sk_trans.SimilarityTransform(translation=(-1 * cx, -1 * cy))
-    t3 = sk_trans.SimilarityTransform(rotation=rot)
-    t4 = sk_trans.SimilarityTransform(translation=(output_size / 2, output_size / 2))
-    t = t1 + t2 + t3 + t4
-    M = t.params[0:2]
+    # scale, move the center to the origin, rotate, then move it to the output center
+    c = scale_ratio * np.cos(rot)
+    s = scale_ratio * np.sin(rot)
+    tx = output_size / 2 - (c * center[0] - s * center[1])
+    ty = output_size / 2 - (s * center[0] + c * center[1])
+    M = np.array([[c, -s, tx], [s, c, ty]])
     cropped = cv2.warpAffine(data, M, (output_size, output_size), borderValue=0.0)
 
     return cropped, M
 
 
 def trans_points2d(pts, M):
-    new_pts = np.zeros(shape=pts.shape, dtype=np.float32)
-    for i in range(pts.shape[0]):
-        pt = pts[i]
-        new_pt = np.array([pt[0], pt[1], 1.0], dtype=np.float32)
-        new_pt = np.dot(M, new_pt)
-        new_pts[i] = new_pt[0:2]
+    pts = pts[:, 0:2].reshape(-1, 1, 2).astype(np.float32)
+    new_pts = cv2.transform(pts, M[:2].astype(np.float32))
 
-    return new_pts
-
-
-def calculate_distance_ratio(
-    lmk: np.ndarray, idx1: int, idx2: int, idx3: int, idx4: int, eps: float = 1e-6
-) -> np.ndarray:
-    return np.linalg.norm(lmk[:, idx1] - lmk[:, idx2], axis=1, keepdims=True) / (
-        np.linalg.norm(lmk[:, idx3] - lmk[:, idx4], axis=1, keepdims=True) + eps
-    )
+    return new_pts.reshape(-1, 2)
 
 
 def get_rotation_matrix(pitch_, yaw_, roll_):
@@ -187,27 +215,23 @@ def get_rotation_matrix(pitch_, yaw_, roll_):
 
     # calculate the euler matrix
     bs = pitch.shape[0]
-    ones = np.ones([bs, 1], dtype=np.float32)
-    zeros = np.zeros([bs, 1], dtype=np.float32)
-    x, y, z = pitch, yaw, roll
-
-    rot_x = np.concatenate(
-        [ones, zeros, zeros, zeros, np.cos(x), -np.sin(x), zeros, np.sin(x), np.cos(x)],
-        axis=1,
-    ).reshape([bs, 3, 3])
-
-    rot_y = np.concatenate(
-        [np.cos(y), zeros, np.sin(y), zeros, ones, zeros, -np.sin(y), zeros, np.cos(y)],
-        axis=1,
-    ).reshape([bs, 3, 3])
-
-    rot_z = np.concatenate(
-        [np.cos(z), -np.sin(z), zeros, np.sin(z), np.cos(z), zeros, zeros, zeros, ones],
-        axis=1,
-    ).reshape([bs, 3, 3])
-
-    rot = rot_z @ rot_y @ rot_x
-    return rot.transpose(0, 2, 1)  # transpose
+    x, y, z = pitch[:, 0], yaw[:, 0], roll[:, 0]
+    cx, sx = np.cos(x), np.sin(x)
+    cy, sy = np.cos(y), np.sin(y)
+    cz, sz = np.cos(z), np.sin(z)
+
+    # closed form of (rot_z @ rot_y @ rot_x).transpose(0, 2, 1)
+    rot = np.empty([bs, 3, 3], dtype=np.result_type(pitch, np.float32))
+    rot[:, 0, 0] = cz * cy
+    rot[:, 1, 0] = cz * sy * sx - sz * cx
+    rot[:, 2, 0] = cz * sy * cx + sz * sx
+    rot[:, 0, 1] = sz * cy
+    rot[:, 1, 1] = sz * sy * sx + cz * cx
+    rot[:, 2, 1] = sz * sy * cx - cz * sx
+    rot[:, 0, 2] = -sy
+    rot[:, 1, 2] = cy * sx
+    rot[:, 2, 2] = cy * cx
+    return rot
 
 
 def transform_keypoint(kp_info: dict):
@@ -277,8 +301,15 @@ def concat_frame(driving_img, src_img, I_p):
 
 
 def get_face_analysis(det_face, landmark):
-
-    def get_landmark(img, face):
+    # anchor centers only depend on the input size and stride, keep them across calls
+    center_cache = {}
+    # the letterboxed detector input is rewritten on each call
+    det_buf = np.zeros((512, 512, 3), dtype=np.uint8)
+    # NCHW float32 inputs of the detector and the landmark model
+    blob_buf = np.empty((1, 3, 512, 512), dtype=np.float32)
+    aimg_buf = np.empty((1, 3, 192, 192), dtype=np.float32)
+
+    def get_landmark(img, face, aimg_buf=aimg_buf):
         input_size = 192
 
         bbox = face["bbox"]
@@ -289,9 +320,9 @@ def get_face_analysis(det_face, landmark):
         aimg, M = face_align(img, center, input_size, _scale, rotate)
         input_size = tuple(aimg.shape[0:2][::-1])
 
-        aimg = aimg.transpose(2, 0, 1)  # HWC -> CHW
-        aimg = np.expand_dims(aimg, axis=0)
-        aimg = aimg.astype(np.float32)
+        # HWC -> 1xCxHxW, written into the float32 buffer
+        np.copyto(aimg_buf[0], aimg.transpose(2, 0, 1), casting="unsafe")
+        aimg = aimg_buf
 
         # feedforward
         if not args.onnx:
@@ -320,14 +351,21 @@ def get_face_analysis(det_face, landmark):
             new_width = input_size
             new_height = int(new_width * im_ratio)
         det_scale = float(new_height) / img.shape[0]
-        resized_img = cv2.resize(img, (new_width, new_height))
-        det_img = np.zeros((input_size, input_size, 3), dtype=np.uint8)
-        det_img[:new_height, :new_width, :] = resized_img
 
-        det_img = (det_img - 127.5) / 128
-        det_img = det_img.transpose(2, 0, 1)  # HWC -> CHW
-        det_img = np.expand_dims(det_img, axis=0)
-        det_img = det_img.astype(np.float32)
+        # resize, then copy to the top-left corner of the zero-padded square
+        resized_img = cv2.resize(img, (new_width, new_height))
+        det_img = det_buf
+        det_img[:new_height, :new_width] = resized_img
+        det_img[new_height:] = 0
+        det_img[:, new_width:] = 0
+
+        # (x - mean) * scale, HWC -> CHW, in a single float32 buffer
+        blob = blob_buf
+        np.subtract(
+            det_img.transpose(2, 0, 1), DET_INPUT_MEAN, out=blob[0], dtype=np.float32
+        )
+        blob *= DET_INPUT_SCALE
+        det_img = blob
 
         # feedforward
         if not args.onnx:
@@ -342,12 +380,10 @@ def get_face_analysis(det_face, landmark):
         det_thresh = 0.5
         fmc = 3
         feat_stride_fpn = [8, 16, 32]
-        center_cache = {}
         for idx, stride in enumerate(feat_stride_fpn):
             scores = output[idx]
             bbox_preds = output[idx + fmc]
-            bbox_preds = bbox_preds * stride
-            kps_preds = output[idx + fmc * 2] * stride
+            kps_preds = output[idx + fmc * 2]
             height = input_size // stride
             width = input_size // stride
             K = height * width
@@ -361,34 +397,47 @@ def get_face_analysis(det_face, landmark):
 
                 anchor_centers = (anchor_centers * stride).reshape((-1, 2))
                 num_anchors = 2
-                anchor_centers = np.stack(
-                    [anchor_centers] * num_anchors, axis=1
-                ).reshape((-1, 2))
+                anchor_centers = np.ascontiguousarray(
+                    np.stack([anchor_centers] * num_anchors, axis=1).reshape((-1, 2))
+                )
                 if len(center_cache) < 100:
                     center_cache[key] = anchor_centers
 
+            # filter by score first, then decode only the positive anchors
             pos_inds = np.where(scores >= det_thresh)[0]
-            bboxes = distance2bbox(anchor_centers, bbox_preds)
+            pos_anchors = anchor_centers[pos_inds]
+            pos_bbox_preds = bbox_preds[pos_inds] * stride
+            pos_kps_preds = kps_preds[pos_inds] * stride
             pos_scores = scores[pos_inds]
-            pos_bboxes = bboxes[pos_inds]
+            pos_bboxes = distance2bbox(pos_anchors, pos_bbox_preds)
             scores_list.append(pos_scores)
             bboxes_list.append(pos_bboxes)
 
-            kpss = distance2kps(anchor_centers, kps_preds)
-            kpss = kpss.reshape((kpss.shape[0], -1, 2))
-            pos_kpss = kpss[pos_inds]
+            pos_kpss = distance2kps(pos_anchors, pos_kps_preds)
+            pos_kpss = pos_kpss.reshape(
+                (pos_kpss.shape[0], kps_preds.shape[1] // 2, 2)
+            )
             kpss_list.append(pos_kpss)
 
         scores = np.vstack(scores_list)
+        if scores.shape[0] == 0:
+            # no face in the image
+            return []
         scores_ravel = scores.ravel()
-        order = scores_ravel.argsort()[::-1]
+        # only the best candidates are passed to nms, partial sort if there are many
+        nms_pre = 1000
+        if scores_ravel.shape[0] > nms_pre:
+            order = np.argpartition(-scores_ravel, nms_pre - 1)[:nms_pre]
+            order = order[np.argsort(-scores_ravel[order])]
+        else:
+            order = scores_ravel.argsort()[::-1]
         bboxes = np.vstack(bboxes_list) / det_scale
         kpss = np.vstack(kpss_list) / det_scale
         pre_det = np.hstack((bboxes, scores)).astype(np.float32, copy=False)
         pre_det = pre_det[order, :]
 
         nms_thresh = 0.4
-        keep = nms_boxes(pre_det, [1 for s in pre_det], nms_thresh)
+        keep = nms(pre_det, nms_thresh)
         bboxes = pre_det[keep, :]
         kpss = kpss[order, :, :]
         kpss = kpss[keep, :, :]
@@ -404,11 +453,25 @@ def get_face_analysis(det_face, landmark):
             if kpss is not None:
                 kps = kpss[i]
             face = dict(bbox=bbox, kps=kps, det_score=det_score)
-            lmk = get_landmark(img, face)
-            face["landmark_2d_106"] = lmk
-
             ret.append(face)
 
+        if len(ret) > 1 and args.onnx:
+            # onnxruntime releases the GIL while running, overlap the faces
+            # (each thread gets its own input buffer)
+            with ThreadPoolExecutor(max_workers=min(4, len(ret))) as executor:
+                lmks = list(
+                    executor.map(
+                        lambda face: get_landmark(
+                            img, face, np.empty_like(aimg_buf)
+                        ),
+                        ret,
+                    )
+                )
+        else:
+            lmks = [get_landmark(img, face) for face in ret]
+        for face, lmk in zip(ret, lmks):
+            face["landmark_2d_106"] = lmk
+
         src_face = sorted(
             ret,
             key=lambda face: (face["bbox"][2] - face["bbox"][0])
@@ -421,6 +484,21 @@ def get_face_analysis(det_face, landmark):
     return face_analysis
 
 
+def cache_face_analysis(face_analysis):
+    # the source image and the first driving frame can be the same picture,
+    # run the detector and landmark models only once per distinct image
+    cache = {}
+
+    def cached(img):
+        img = np.ascontiguousarray(img)
+        key = (img.shape, hashlib.sha1(img).hexdigest())
+        if key not in cache:
+            cache[key] = face_analysis(img)
+        return cache[key]
+
+    return cached
+
+
 def setup_facemesh(det_face, landmark):
     mod = load_facemesh_v2(args)
 
@@ -569,14 +647,15 @@ def setup_facemesh(det_face, landmark):
     return face_analysis
 
 
-def preprocess(img):
-    img = img / 255.0
-    img = np.clip(img, 0, 1)  # clip to 0~1
-    img = img.transpose(2, 0, 1)  # HxWx3x1 -> 1x3xHxW
-    img = np.expand_dims(img, axis=0)
-    img = img.astype(np.float32)
+def preprocess(img, out=None):
+    # HxWx3 -> 1x3xHxW, written once into a float32 buffer
+    if out is None:
+        out = np.empty((1, 3, img.shape[0], img.shape[1]), dtype=np.float32)
+    x = out
+    np.divide(img.transpose(2, 0, 1), 255, out=x[0], dtype=np.float32)
+    np.clip(x, 0, 1, out=x)  # clip to 0~1
 
-    return img
+    return x
 
 
 def src_preprocess(img):
@@ -637,12 +716,7 @@ def crop_src_image(models, img):
 
 def landmark_runner(models, img, lmk):
     crop_dct = crop_image(img, lmk, dsize=224, scale=1.5, vy_ratio=-0.1)
-    img_crop = crop_dct["img_crop"]
-
-    img_crop = img_crop / 255
-    img_crop = img_crop.transpose(2, 0, 1)  # HWC -> CHW
-    img_crop = np.expand_dims(img_crop, axis=0)
-    img_crop = img_crop.astype(np.float32)
+    img_crop = preprocess(crop_dct["img_crop"], out=landmark_runner.buf)
 
     # feedforward
     net = models["landmark_runner"]
@@ -656,7 +730,9 @@ def landmark_runner(models, img, lmk):
     lmk = out_pts[0].reshape(-1, 2) * 224  # scale to 0-224
     # _transform_pts
     M = crop_dct["M_c2o"]
-    lmk = lmk @ M[:2, :2].T + M[:2, 2]
+    lmk = cv2.transform(
+        lmk.reshape(-1, 1, 2).astype(np.float32), M[:2].astype(np.float32)
+    ).reshape(-1, 2)
 
     return lmk
 
@@ -685,19 +761,20 @@ def get_kp_info(models, x):
         output = net.run(None, {"x": x})
     pitch, yaw, roll, t, exp, scale, kp = output
 
-    kp_info = dict(pitch=pitch, yaw=yaw, roll=roll, t=t, exp=exp, scale=scale, kp=kp)
-
-    pred = softmax(kp_info["pitch"], axis=1)
-    degree = np.sum(pred * np.arange(66), axis=1) * 3 - 97.5
-    kp_info["pitch"] = degree[:, None]  # Bx1
-    pred = softmax(kp_info["yaw"], axis=1)
-    degree = np.sum(pred * np.arange(66), axis=1) * 3 - 97.5
-    kp_info["yaw"] = degree[:, None]  # Bx1
-    pred = softmax(kp_info["roll"], axis=1)
-    degree = np.sum(pred * np.arange(66), axis=1) * 3 - 97.5
-    kp_info["roll"] = degree[:, None]  # Bx1
-
-    kp_info = {k: v.astype(np.float32) for k, v in kp_info.items()}
+    # pitch, yaw and roll in one softmax and expectation over the bins
+    pred = softmax(np.stack([pitch, yaw, roll], axis=1), axis=2)  # Bx3x66
+    degree = pred @ POSE_BINS  # Bx3
+
+    kp_info = dict(
+        pitch=degree[:, 0:1],  # Bx1
+        yaw=degree[:, 1:2],  # Bx1
+        roll=degree[:, 2:3],  # Bx1
+        t=t,
+        exp=exp,
+        scale=scale,
+        kp=kp,
+    )
+    kp_info = {k: v.astype(np.float32, copy=False) for k, v in kp_info.items()}
 
     bs = kp_info["kp"].shape[0]
     kp_info["kp"] = kp_info["kp"].reshape(bs, -1, 3)  # BxNx3
@@ -750,30 +827,47 @@ def warp_decode(models, feature_3d, kp_source, kp_driving):
     net = models["warping_module"]
     if not args.onnx:
         output = net.predict([feature_3d, kp_source, kp_driving])
+        out, occlusion_map, deformation = output
+        out = out.astype(np.float32)
     else:
-        output = net.run(
-            None,
-            {
-                "feature_3d": feature_3d,
-                "kp_source": kp_source,
-                "kp_driving": kp_driving,
-            },
-        )
-    out, occlusion_map, deformation = output
-    out = out.astype(np.float32)
+        device = "cuda" if "CUDAExecutionProvider" in net.get_providers() else "cpu"
+        io_binding = models["io_binding"]["warping_module"]
+        # feature_3d and kp_source are the same for every frame of a source image,
+        # copy them to the device only once
+        if warp_decode.feature_3d is not feature_3d:
+            io_binding.bind_ortvalue_input(
+                "feature_3d",
+                onnxruntime.OrtValue.ortvalue_from_numpy(feature_3d, device, 0),
+            )
+            warp_decode.feature_3d = feature_3d
+        if warp_decode.kp_source is not kp_source:
+            io_binding.bind_ortvalue_input(
+                "kp_source",
+                onnxruntime.OrtValue.ortvalue_from_numpy(kp_source, device, 0),
+            )
+            warp_decode.kp_source = kp_source
+        io_binding.bind_cpu_input("kp_driving", kp_driving)
+        # the warped feature stays on the device for the generator
+        output_names = [output.name for output in net.get_outputs()]
+        io_binding.bind_output(output_names[0], device)
+        for name in output_names[1:]:
+            io_binding.bind_output(name, "cpu")
+        net.run_with_iobinding(io_binding)
+        out, occlusion_map, deformation = io_binding.get_outputs()
+        occlusion_map = occlusion_map.numpy()
+        deformation = deformation.numpy()
 
     # decode
     net = models["spade_generator"]
     if not args.onnx:
         output = net.predict([out])
+        out = output[0]
     else:
-        output = net.run(
-            None,
-            {
-                "feature": out,
-            },
-        )
-    out = output[0]
+        io_binding = models["io_binding"]["spade_generator"]
+        io_binding.bind_ortvalue_input("feature", out)
+        io_binding.bind_output(net.get_outputs()[0].name, "cpu")
+        net.run_with_iobinding(io_binding)
+        out = io_binding.get_outputs()[0].numpy()
 
     ret_dct = {
         "out": out.astype(np.float32),
@@ -784,10 +878,9 @@ def warp_decode(models, feature_3d, kp_source, kp_driving):
     return ret_dct
 
 
-def predict(models, x_s_info, R_s, f_s, x_s, img):
+def driving_landmark(models, img):
     # calc_lmks_from_cropped_video
-    frame_0 = predict.lmk is None
-    if frame_0:
+    if predict.lmk is None:
         face_analysis = models["face_analysis"]
         src_face = face_analysis(img)
         if len(src_face) == 0:
@@ -804,23 +897,25 @@ def predict(models, x_s_info, R_s, f_s, x_s, img):
         lmk = landmark_runner(models, img, predict.lmk)
     predict.lmk = lmk
 
-    # calc_driving_ratio
-    lmk = lmk[None]
-    c_d_eyes = np.concatenate(
-        [
-            calculate_distance_ratio(lmk, 6, 18, 0, 12),
-            calculate_distance_ratio(lmk, 30, 42, 24, 36),
-        ],
-        axis=1,
-    )
-    c_d_lip = calculate_distance_ratio(lmk, 90, 102, 48, 66)
-    c_d_eyes = c_d_eyes.astype(np.float32)
-    c_d_lip = c_d_lip.astype(np.float32)
-
     # prepare_driving_videos
-    img = cv2.resize(img, (256, 256))
+    img = cv2.resize(
+        img, (256, 256), dst=driving_landmark.buf, interpolation=cv2.INTER_LINEAR
+    )
     I_d = preprocess(img)
 
+    return I_d
+
+
+def predict(models, x_s_info, R_s, f_s, x_s, imgs):
+    """generate a frame for each driving frame in imgs
+    f_s, x_s: source feature and keypoints, repeated to at least len(imgs)
+    """
+    frame_0 = predict.rel_info is None
+
+    # the landmarks are tracked from frame to frame
+    I_d = np.concatenate([driving_landmark(models, img) for img in imgs], axis=0)
+    bs = I_d.shape[0]
+
     # collect s_d, R_d, δ_d and t_d for inference
     x_d_info = get_kp_info(models, I_d)
     R_d = get_rotation_matrix(x_d_info["pitch"], x_d_info["yaw"], x_d_info["roll"])
@@ -832,35 +927,50 @@ def predict(models, x_s_info, R_s, f_s, x_s, img):
     }
 
     if frame_0:
-        predict.x_d_0_info = x_d_info
-
-    x_d_0_info = predict.x_d_0_info
-    R_d_0 = x_d_0_info["R_d"]
+        # the motion relative to the first driving frame is applied to the source,
+        # fold the terms that only depend on the source and frame 0 once
+        x_d_0_info = {k: v[0:1] for k, v in x_d_info.items()}
+        predict.rel_info = {
+            "R": x_d_0_info["R_d"].transpose(0, 2, 1) @ R_s,
+            "exp": x_s_info["exp"] - x_d_0_info["exp"],
+            "scale": x_s_info["scale"] / x_d_0_info["scale"],
+            "t": x_s_info["t"] - x_d_0_info["t"],
+            "x_c_s": np.ascontiguousarray(x_s_info["kp"], dtype=np.float32),
+        }
+    rel_info = predict.rel_info
 
-    R_new = (R_d @ R_d_0.transpose(0, 2, 1)) @ R_s
-    delta_new = x_s_info["exp"] + (x_d_info["exp"] - x_d_0_info["exp"])
-    scale_new = x_s_info["scale"] * (x_d_info["scale"] / x_d_0_info["scale"])
-    t_new = x_s_info["t"] + (x_d_info["t"] - x_d_0_info["t"])
+    R_new = R_d @ rel_info["R"]
+    delta_new = x_d_info["exp"] + rel_info["exp"]
+    scale_new = x_d_info["scale"] * rel_info["scale"]
+    t_new = x_d_info["t"] + rel_info["t"]
 
     t_new[..., 2] = 0  # zero tz
-    x_c_s = x_s_info["kp"]
-    x_d_new = scale_new * (x_c_s @ R_new + delta_new) + t_new
+    x_c_s = rel_info["x_c_s"]
+    x_d_new = scale_new[..., None] * (x_c_s @ R_new + delta_new) + t_new[:, None, :]
+
+    # the source is shared by the batch, keep the same arrays when the batch is full
+    if f_s.shape[0] != bs:
+        f_s = f_s[:bs]
+        x_s = x_s[:bs]
 
     # with stitching and without retargeting
     x_d_new = stitching(models, x_s, x_d_new)
 
     out = warp_decode(models, f_s, x_s, x_d_new)
     out = out["out"]
-    out = out.transpose(0, 2, 3, 1)  # 1x3xHxW -> 1xHxWx3
+    out = out.transpose(0, 2, 3, 1)  # Bx3xHxW -> BxHxWx3
     out = np.clip(out, 0, 1)  # clip to 0~1
     out = (out * 255).astype(np.uint8)  # 0~1 -> 0~255
-    I_p = out[0]
 
-    return I_p
+    return list(out)
 
 
 predict.lmk = None
-predict.x_d_0_info = None
+driving_landmark.buf = np.empty((256, 256, 3), dtype=np.uint8)
+landmark_runner.buf = np.empty((1, 3, 224, 224), dtype=np.float32)
+predict.rel_info = None
+warp_decode.feature_3d = None
+warp_decode.kp_source = None
 
 
 def warmup(models):
@@ -935,7 +1045,7 @@ def recognize_from_video(models):
     mask_crop = load_image(MASK_PATH)
     mask_crop = cv2.cvtColor(mask_crop, cv2.COLOR_BGRA2BGR)
 
-    img = img[:, :, ::-1]  # BGR -> RGB
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
     src_img = src_preprocess(img)
     crop_info = crop_src_image(models, src_img)
 
@@ -951,6 +1061,12 @@ def recognize_from_video(models):
     f_s = extract_feature_3d(models, I_s)
     x_s = transform_keypoint(x_s_info)
 
+    # source feature and keypoints for a whole batch of driving frames
+    batch_size = max(1, args.batch_size)
+    if batch_size > 1:
+        f_s = np.repeat(f_s, batch_size, axis=0)
+        x_s = np.repeat(x_s, batch_size, axis=0)
+
     capture = get_capture(driving_video)
     assert capture.isOpened(), "Cannot capture source"
     # capture = imageio.get_reader(file_path, "ffmpeg")
@@ -968,35 +1084,51 @@ def recognize_from_video(models):
         mask_crop, crop_info["M_c2o"], dsize=(src_img.shape[1], src_img.shape[0])
     )
 
+    # the GUI event loop (and its 1 ms wait) is only needed when showing frames
+    show = not args.cui or args.video
     frame_shown = False
+    frames = []
     while True:
         ret, frame = capture.read()
-        if (cv2.waitKey(1) & 0xFF == ord("q")) or not ret:
-            break
-        if frame_shown and cv2.getWindowProperty("frame", cv2.WND_PROP_VISIBLE) == 0:
+        if show:
+            if cv2.waitKey(1) & 0xFF == ord("q"):
+                break
+            if frame_shown and cv2.getWindowProperty("frame", cv2.WND_PROP_VISIBLE) == 0:
+                break
+
+        if ret:
+            frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            if len(frames) < batch_size:
+                continue
+        if len(frames) == 0:
             break
 
         # inference
-        img_rgb = frame[:, :, ::-1]  # BGR -> RGB
-        I_p = predict(models, x_s_info, R_s, f_s, x_s, img_rgb)
+        I_p_list = predict(models, x_s_info, R_s, f_s, x_s, frames)
 
-        if flg_composite:
-            driving_img = concat_frame(img_rgb, img_crop_256x256, I_p)
-        else:
-            driving_img = paste_back(I_p, crop_info["M_c2o"], src_img, mask_ori)
-        driving_img = driving_img[:, :, ::-1]  # RGB -> BGR
+        for img_rgb, I_p in zip(frames, I_p_list):
+            if flg_composite:
+                driving_img = concat_frame(img_rgb, img_crop_256x256, I_p)
+            else:
+                driving_img = paste_back(I_p, crop_info["M_c2o"], src_img, mask_ori)
+            driving_img = cv2.cvtColor(driving_img, cv2.COLOR_RGB2BGR)
 
-        # show
-        if not args.cui or args.video:
-            cv2.imshow("frame", driving_img)
-            frame_shown = True
+            # show
+            if show:
+                cv2.imshow("frame", driving_img)
+                frame_shown = True
 
-        # save results
-        if writer is not None:
-            writer.write(driving_img)
+            # save results
+            if writer is not None:
+                writer.write(driving_img)
+        frames.clear()
+
+        if not ret:
+            break
 
     capture.release()
-    cv2.destroyAllWindows()
+    if show:
+        cv2.destroyAllWindows()
     if writer is not None:
         writer.release()
         logger.info(f"Result was saved as {args.savepath}")
@@ -1041,15 +1173,19 @@ def main():
             det_face = ailia.Net(MODEL_FM_DET_PATH, WEIGHT_FM_DET_PATH, env_id=env_id)
             landmark = ailia.Net(MODEL_FM_LMK_PATH, WEIGHT_FM_LMK_PATH, env_id=env_id)
     else:
-        import onnxruntime
-
         onnxruntime.set_default_logger_severity(3)
 
         providers = ["CUDAExecutionProvider", "CPUExecutionProvider"]
         net_f = onnxruntime.InferenceSession(WEIGHT_F_PATH, providers=providers)
         net_m = onnxruntime.InferenceSession(WEIGHT_M_PATH, providers=providers)
-        net_w = onnxruntime.InferenceSession(WEIGHT_W_PATH, providers=providers)
-        net_g = onnxruntime.InferenceSession(WEIGHT_G_PATH, providers=providers)
+        # the warping module and generator run every frame with fixed shapes,
+        # so an exhaustive cudnn algorithm search pays off
+        conv_providers = [
+            ("CUDAExecutionProvider", {"cudnn_conv_algo_search": "EXHAUSTIVE"}),
+            "CPUExecutionProvider",
+        ]
+        net_w = onnxruntime.InferenceSession(WEIGHT_W_PATH, providers=conv_providers)
+        net_g = onnxruntime.InferenceSession(WEIGHT_G_PATH, providers=conv_providers)
         net_s = onnxruntime.InferenceSession(WEIGHT_S_PATH, providers=providers)
         net_l = onnxruntime.InferenceSession(WEIGHT_L_PATH, providers=providers)
 
@@ -1072,6 +1208,7 @@ def main():
         face_analysis = setup_facemesh(det_face, landmark)
     else:
         face_analysis = get_face_analysis(det_face, landmark)
+    face_analysis = cache_face_analysis(face_analysis)
 
     models = {
         "appearance_feature_extractor": net_f,
@@ -1082,6 +1219,11 @@ def main():
         "landmark_runner": net_l,
         "face_analysis": face_analysis,
     }
+    if args.onnx:
+        models["io_binding"] = {
+            "warping_module": net_w.io_binding(),
+            "spade_generator": net_g.io_binding(),
+        }
 
     warmup(models)
 